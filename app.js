@@ -11,12 +11,64 @@ var app = new Vue({
     },
     
     methods: {
-        fetchData: function() {
+        fetchData: function(cursor, loaded) {
             let vm = this;
-            this.$http.get("api/observations").then(function( response ) {
-                vm.observations = JSON.parse(response.body);
+            let url = "api/observations?limit=5000";
+            loaded = loaded || [];
+
+            if (cursor) {
+                url += "&cursor=" + cursor;
+            }
+
+            // Follow the page cursors and only hand the full list to
+            // the table once the last page has arrived
+            this.$http.get(url).then(function( response ) {
+                let page = JSON.parse(response.body);
+                loaded = loaded.concat(page.observations);
+
+                if (page.next) {
+                    vm.fetchData(page.next, loaded);
+                } else {
+                    vm.observations = loaded;
+                    vm.subscribe(loaded.length ? loaded[0].time : null);
+                }
+            });
+        },
+
+        subscribe: function(since) {
+            let vm = this;
+            let url = "api/stream" + (since === null ? "" : "?since=" + since);
+
+            // New readings are added to the table as they are stored,
+            // long-polling where EventSource is not available
+            if (window.EventSource) {
+                let source = new EventSource(url);
+                source.addEventListener("observation", function(event) {
+                    vm.addObservations([JSON.parse(event.data)]);
+                });
+            } else {
+                this.poll(since);
+            }
+        },
+
+        poll: function(since) {
+            let vm = this;
+            let url = "api/stream/poll" + (since === null ? "" : "?since=" + since);
+
+            this.$http.get(url).then(function( response ) {
+                let page = JSON.parse(response.body);
+                vm.addObservations(page.observations);
+                vm.poll(page.next);
+            }, function() {
+                setTimeout(function() { vm.poll(since); }, 3000);
             });
         },
+
+        addObservations: function(observations) {
+            if (this.datatable && observations.length) {
+                this.datatable.rows.add(observations).draw(false);
+            }
+        },
     },
 
    watch: { 
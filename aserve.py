@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+
+"""
+    asyncio server for the weather API, an alternative to running serve.py
+    under uWSGI. Requires Python 3.7 or later.
+
+    Connections are handled by the event loop, so idle keep-alive
+    connections from open dashboards cost a coroutine rather than a
+    worker. Requests are answered by the same Bottle routes as serve.py,
+    each one run on a bounded pool of DB_THREADS threads since the sqlite
+    calls behind them block. Responses are streamed back a chunk at a
+    time, the pool thread waits while the client is slow to read.
+
+    /api/stream and /api/stream/poll are answered on the event loop
+    itself, woken by the live feed, so open event streams and waiting long
+    polls do not hold a pool thread either. Only their replay from the
+    database runs on the pool.
+
+    Standalone, stdlib only:
+        python3 aserve.py [--host HOST] [--port PORT] [--threads N]
+
+    Under an ASGI server, for example:
+        uvicorn aserve:asgi
+"""
+
+import asyncio
+import concurrent.futures
+import io
+import json
+import signal
+import sys
+from urllib.parse import parse_qs, unquote
+
+import live
+import serve
+from observation import ParseFields, Project
+
+# Threads running routes, each holds its own pooled database connection
+DB_THREADS = 4
+
+# Seconds an idle keep-alive connection is kept open
+KEEPALIVE_TIMEOUT = 300
+
+# Largest request head and body accepted
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=DB_THREADS)
+
+
+def Dispatch(environ, emit):
+    """
+        Runs the Bottle app for environ on a pool thread. emit(status,
+        headers, chunk) is called with each chunk of the response body and
+        once more with chunk None at the end, and blocks until the chunk
+        has been sent.
+    """
+    response = dict()
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = status
+        response["headers"] = headers
+        return lambda data: emit(response["status"], response["headers"], data)
+
+    result = serve.app(environ, start_response)
+    try:
+        for chunk in result:
+            if chunk:
+                emit(response["status"], response["headers"], chunk)
+        emit(response["status"], response["headers"], None)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+
+async def BadRequest(send, message):
+    await send("400 Bad Request", [("Content-Type", "text/plain")], message.encode())
+    await send("400 Bad Request", [], None)
+
+
+async def Stream(environ, send):
+    """
+        Serves /api/stream, send(status, headers, chunk) is awaited with
+        each chunk. Runs until the client goes away.
+    """
+    query = parse_qs(environ["QUERY_STRING"])
+    try:
+        since = environ.get("HTTP_LAST_EVENT_ID") or query.get("since", [""])[0]
+        since = serve.timestampInt(since) if since else None
+    except ValueError:
+        await BadRequest(send, "since must be an integer timestamp")
+        return
+
+    try:
+        fields = ParseFields(query.get("fields", [""])[0])
+    except ValueError as e:
+        await BadRequest(send, str(e))
+        return
+
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+    listener = lambda: loop.call_soon_threadsafe(woken.set)
+    live.FEED.Listen(listener)
+    try:
+        observations = await loop.run_in_executor(POOL,
+                lambda: live.Replay(serve.WeatherHistory(None), since, fields))
+        if since is None:
+            since = serve.WeatherHistory.MIN_TIMESTAMP
+
+        status = "200 OK"
+        headers = [("Content-Type", "text/event-stream"), ("Cache-Control", "no-cache"),
+                   ("X-Accel-Buffering", "no")]
+        await send(status, headers, "retry: {}\n\n".format(live.RETRY).encode())
+
+        while True:
+            if observations:
+                since = observations[-1]["time"]
+                await send(status, headers, "".join(live.Event(Project(obs, fields))
+                                                    for obs in observations).encode())
+
+            woken.clear()
+            observations = live.FEED.Since(since)
+            if observations:
+                continue
+
+            try:
+                await asyncio.wait_for(woken.wait(), live.HEARTBEAT)
+            except asyncio.TimeoutError:
+                await send(status, headers, live.Heartbeat().encode())
+            observations = live.FEED.Since(since)
+    finally:
+        live.FEED.Unlisten(listener)
+
+
+async def Poll(environ, send):
+    """
+        Serves /api/stream/poll as serve.streamPoll does, but waits for new
+        observations on the event loop. Only observations published by
+        this process wake it.
+    """
+    query = parse_qs(environ["QUERY_STRING"])
+    try:
+        since = environ.get("HTTP_LAST_EVENT_ID") or query.get("since", [""])[0]
+        since = serve.timestampInt(since) if since else None
+    except ValueError:
+        await BadRequest(send, "since must be an integer timestamp")
+        return
+
+    try:
+        fields = ParseFields(query.get("fields", [""])[0])
+    except ValueError as e:
+        await BadRequest(send, str(e))
+        return
+
+    try:
+        timeout = int(query.get("timeout", [serve.POLL_TIMEOUT])[0])
+    except ValueError:
+        timeout = -1
+    if timeout < 0 or timeout > serve.POLL_TIMEOUT:
+        await BadRequest(send, "timeout must be between 0 and {}".format(serve.POLL_TIMEOUT))
+        return
+
+    loop = asyncio.get_running_loop()
+    woken = asyncio.Event()
+    listener = lambda: loop.call_soon_threadsafe(woken.set)
+    live.FEED.Listen(listener)
+    try:
+        observations = await loop.run_in_executor(POOL,
+                lambda: live.Replay(serve.WeatherHistory(None), since, fields))
+        if not observations:
+            after = serve.WeatherHistory.MIN_TIMESTAMP if since is None else since
+            deadline = loop.time() + timeout
+            while True:
+                woken.clear()
+                observations = [Project(obs, fields) for obs in live.FEED.Since(after)]
+                remaining = deadline - loop.time()
+                if observations or remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(woken.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        live.FEED.Unlisten(listener)
+
+    if observations:
+        since = observations[-1]["time"]
+
+    body = json.dumps({
+        "observations": observations,
+        "next": None if since is None else str(since)
+    }).encode()
+    headers = [("Content-Type", "application/json"), ("Cache-Control", "no-cache"),
+               ("Content-Length", str(len(body)))]
+    await send("200 OK", headers, body)
+    await send("200 OK", headers, None)
+
+
+def Environ(method, target, protocol, headers, body, server, client):
+    # PEP 3333 environ, header names are lower case
+    path, _, query = target.partition("?")
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": unquote(path, "latin-1"),
+        "QUERY_STRING": query,
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": protocol,
+        "REMOTE_ADDR": client[0] if client else "",
+        "CONTENT_TYPE": headers.pop("content-type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    headers.pop("content-length", None)
+    for name, value in headers.items():
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+    return environ
+
+
+class Connection:
+    """
+        One HTTP/1.1 client connection, requests are answered in turn.
+        Bodies without a Content-Length are sent chunked, or by closing
+        the connection for HTTP/1.0 clients.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._server = writer.get_extra_info("sockname")[:2]
+        self._client = writer.get_extra_info("peername")
+
+    async def Run(self):
+        try:
+            keepAlive = True
+            while keepAlive:
+                try:
+                    head = await asyncio.wait_for(self._reader.readuntil(b"\r\n\r\n"),
+                                                  KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._Error("431 Request Header Fields Too Large")
+                    return
+
+                keepAlive = await self._Handle(head)
+        except ConnectionError:
+            pass
+        finally:
+            self._writer.close()
+
+    async def _Handle(self, head):
+        # Answers one request, returns whether the connection stays open
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, protocol = lines[0].split(" ")
+        except ValueError:
+            await self._Error("400 Bad Request")
+            return False
+
+        headers = dict()
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", ""):
+            await self._Error("411 Length Required")
+            return False
+
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY_SIZE:
+            await self._Error("413 Payload Too Large")
+            return False
+        body = await self._reader.readexactly(length) if length else b""
+
+        connection = headers.get("connection", "").lower()
+        self._keepAlive = protocol == "HTTP/1.1" and connection != "close" \
+            or protocol == "HTTP/1.0" and connection == "keep-alive"
+        self._head = method == "HEAD"
+        self._protocol = protocol
+        self._started = False
+        self._chunked = False
+
+        environ = Environ(method, target, protocol, headers, body, self._server, self._client)
+        if method == "GET" and environ["PATH_INFO"] == "/api/stream":
+            self._keepAlive = False
+            await Stream(environ, self._Send)
+            return False
+        if method in ("GET", "HEAD") and environ["PATH_INFO"] == "/api/stream/poll":
+            await Poll(environ, self._Send)
+            return self._keepAlive
+
+        loop = asyncio.get_running_loop()
+
+        def emit(status, responseHeaders, chunk):
+            asyncio.run_coroutine_threadsafe(self._Send(status, responseHeaders, chunk),
+                                             loop).result()
+
+        await loop.run_in_executor(POOL, Dispatch, environ, emit)
+        return self._keepAlive
+
+    async def _Send(self, status, headers, chunk):
+        # Runs on the event loop, the first call sends the response head
+        if not self._started:
+            self._started = True
+            names = set(name.lower() for name, value in headers)
+            if "content-length" not in names and not self._head:
+                if self._protocol == "HTTP/1.1":
+                    self._chunked = True
+                    headers = headers + [("Transfer-Encoding", "chunked")]
+                else:
+                    self._keepAlive = False
+            headers = [h for h in headers if h[0].lower() != "connection"]
+            headers.append(("Connection", "keep-alive" if self._keepAlive else "close"))
+
+            head = "{} {}\r\n".format(self._protocol, status)
+            head += "".join("{}: {}\r\n".format(name, value) for name, value in headers)
+            self._writer.write((head + "\r\n").encode("latin-1"))
+
+        if self._head:
+            pass
+        elif chunk is None:
+            if self._chunked:
+                self._writer.write(b"0\r\n\r\n")
+        elif self._chunked:
+            self._writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        else:
+            self._writer.write(chunk)
+
+        await self._writer.drain()
+
+    async def _Error(self, status):
+        self._writer.write("HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                           .format(status).encode("latin-1"))
+        await self._writer.drain()
+
+
+async def asgi(scope, receive, send):
+    """
+        ASGI application serving the same routes, for running under an
+        ASGI server instead of the standalone loop.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.get_running_loop().run_in_executor(None, serve.shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    body = b""
+    more = True
+    while more:
+        message = await receive()
+        body += message.get("body", b"")
+        more = message.get("more_body", False)
+
+    headers = dict((name.decode("latin-1"), value.decode("latin-1"))
+                   for name, value in scope["headers"])
+    target = scope.get("raw_path", b"").decode("latin-1") or scope["path"]
+    if scope.get("query_string"):
+        target += "?" + scope["query_string"].decode("latin-1")
+
+    environ = Environ(scope["method"], target, "HTTP/" + scope["http_version"], headers, body,
+                      scope.get("server") or ("localhost", 80), scope.get("client"))
+    loop = asyncio.get_running_loop()
+    started = list()
+
+    async def respond(status, responseHeaders, chunk):
+        if not started:
+            started.append(True)
+            await send({
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                            for name, value in responseHeaders]
+            })
+        await send({
+            "type": "http.response.body",
+            "body": chunk or b"",
+            "more_body": chunk is not None
+        })
+
+    if scope["method"] == "GET" and environ["PATH_INFO"] == "/api/stream":
+        # The stream only ends when the client disconnects
+        task = asyncio.ensure_future(Stream(environ, respond))
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        task.cancel()
+        return
+    if scope["method"] in ("GET", "HEAD") and environ["PATH_INFO"] == "/api/stream/poll":
+        await Poll(environ, respond)
+        return
+
+    def emit(status, responseHeaders, chunk):
+        asyncio.run_coroutine_threadsafe(respond(status, responseHeaders, chunk), loop).result()
+
+    await loop.run_in_executor(POOL, Dispatch, environ, emit)
+
+
+async def Serve(host, port):
+    server = await asyncio.start_server(lambda r, w: Connection(r, w).Run(), host, port,
+                                        limit=MAX_HEADER_SIZE)
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+
+    print("Serving on http://{}:{}/".format(host, port))
+    async with server:
+        await stopped.wait()
+
+    # Commit queued observations from a pool thread, the writer may be
+    # waiting on the disk
+    await loop.run_in_executor(None, serve.shutdown)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="asyncio weather API server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--threads", type=int, default=DB_THREADS)
+    args = parser.parse_args()
+
+    POOL = concurrent.futures.ThreadPoolExecutor(max_workers=args.threads)
+    asyncio.run(Serve(args.host, args.port))
@@ -0,0 +1,6 @@
+"""
+    Benchmarks for the weather station storage and API layers.
+
+    Each module can be run from the repository root, for example:
+        python -m bench.inserts
+"""
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+"""
+    Benchmark suite for the API, run against a synthetic history.
+
+    Serves serve.py's routes from a local threaded wsgiref server over a
+    scratch copy of the dataset generated by bench.dataset and times:
+
+        latest       sequential GET /api/latest
+        range        GET /api/observations for a random day, one page
+        full         GET /api/observations?export=ndjson, the whole history
+        mixed        concurrent clients issuing a weighted mix of reads
+        ingest_batch POST /api/observations/batch, BATCH_SIZE a request
+        ingest       concurrent POST /api/addobservation?durability=commit
+
+    The ingest scenarios run last and append after the end of the history,
+    so they do not change what the reads see. Results are printed as JSON,
+    along with the commit and Python they were measured on, so runs on two
+    commits can be compared:
+
+        python -m bench.api [--dataset FILE] [--years N] > before.json
+        python -m bench.api compare before.json after.json
+
+    With --dataset the history is generated into FILE on the first run and
+    reused afterwards, it is never written to by the benchmark.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+try:
+    from http.client import HTTPConnection
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from httplib import HTTPConnection
+    from SocketServer import ThreadingMixIn
+
+from bench import dataset
+from weather import CloseConnections
+
+DEFAULT_REQUESTS = 500
+DEFAULT_CLIENTS = 8
+DEFAULT_DURATION = 10.0
+DEFAULT_FULL_RUNS = 3
+
+BATCH_SIZE = 500
+
+# Requests of the mixed scenario, (weight, name, path), {day} and {week}
+# are replaced with a random start in the history
+MIX = (
+    (50, "latest", "/api/latest"),
+    (25, "range", "/api/observations?since={day}&until={day_end}&limit=5000"),
+    (15, "downsample", "/api/downsample?since={week}&until={week_end}&points=500"),
+    (10, "rollup", "/api/rollup/hourly?since={week}&until={week_end}"),
+)
+
+# Ratios of a compared metric beyond which compare flags it
+TOLERANCE = 0.1
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def Request(port, method, path, body=None, headers=None):
+    # Returns (status, response body)
+    conn = HTTPConnection("127.0.0.1", port)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def Percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def Summary(latencies, elapsed, **extra):
+    ordered = sorted(latencies)
+    summary = {
+        "requests": len(ordered),
+        "seconds": round(elapsed, 4),
+        "per_second": round(len(ordered) / elapsed, 2) if elapsed else None,
+    }
+    if ordered:
+        for name, fraction in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+            summary[name] = round(Percentile(ordered, fraction) * 1000, 3)
+        summary["max_ms"] = round(ordered[-1] * 1000, 3)
+    summary.update(extra)
+    return summary
+
+
+def Timed(port, method, path, body=None, headers=None):
+    # Returns (seconds, status, response body)
+    begin = time.time()
+    status, data = Request(port, method, path, body, headers)
+    return time.time() - begin, status, data
+
+
+def Check(status, path):
+    if status >= 400:
+        raise RuntimeError("{} answered {}".format(path, status))
+
+
+class Suite:
+    def __init__(self, port, first, last, seed):
+        self.port = port
+        self.first = first
+        self.last = last
+        self.rng = random.Random(seed)
+
+    def Path(self, template, rng):
+        day = rng.randrange(self.first, self.last - 86400, 60)
+        week = rng.randrange(self.first, self.last - 7 * 86400, 60)
+        return template.format(day=day, day_end=day + 86400, week=week, week_end=week + 7 * 86400)
+
+    def Latest(self, requests):
+        latencies = list()
+        begin = time.time()
+        for i in range(requests):
+            seconds, status, data = Timed(self.port, "GET", "/api/latest")
+            Check(status, "/api/latest")
+            latencies.append(seconds)
+
+        return Summary(latencies, time.time() - begin)
+
+    def Range(self, requests):
+        latencies = list()
+        rows = 0
+        begin = time.time()
+        for i in range(requests):
+            path = self.Path(MIX[1][2], self.rng)
+            seconds, status, data = Timed(self.port, "GET", path)
+            Check(status, path)
+            latencies.append(seconds)
+            rows += len(json.loads(data.decode("utf-8"))["observations"])
+
+        return Summary(latencies, time.time() - begin, rows=rows)
+
+    def Full(self, runs):
+        latencies = list()
+        rows = size = 0
+        begin = time.time()
+        for i in range(runs):
+            # Counted as it arrives rather than held, the history is large
+            conn = HTTPConnection("127.0.0.1", self.port)
+            try:
+                start = time.time()
+                conn.request("GET", "/api/observations?export=ndjson")
+                response = conn.getresponse()
+                Check(response.status, "/api/observations?export=ndjson")
+                rows = size = 0
+                while True:
+                    data = response.read(65536)
+                    if not data:
+                        break
+                    rows += data.count(b"\n")
+                    size += len(data)
+                latencies.append(time.time() - start)
+            finally:
+                conn.close()
+
+        elapsed = time.time() - begin
+        return Summary(latencies, elapsed, rows=rows, bytes=size,
+                       rows_per_second=round(rows * runs / elapsed, 1))
+
+    def Mixed(self, clients, duration):
+        weights = list()
+        for weight, name, template in MIX:
+            weights += [(name, template)] * weight
+        latencies = dict((name, list()) for weight, name, template in MIX)
+        errors = list()
+        deadline = time.time() + duration
+
+        def client(seed):
+            rng = random.Random(seed)
+            try:
+                while time.time() < deadline:
+                    name, template = rng.choice(weights)
+                    path = self.Path(template, rng)
+                    seconds, status, data = Timed(self.port, "GET", path)
+                    Check(status, path)
+                    latencies[name].append(seconds)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=client, args=(self.rng.random(),)) for i in range(clients)]
+        begin = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - begin
+        if errors:
+            raise errors[0]
+
+        summary = Summary(sum(latencies.values(), []), elapsed, clients=clients)
+        summary["routes"] = dict((name, Summary(values, elapsed)) for name, values in latencies.items())
+        return summary
+
+    def IngestBatch(self, batches):
+        start = self.last + 60
+        latencies = list()
+        begin = time.time()
+        for i in range(batches):
+            rows = dataset.Observations(start, start + BATCH_SIZE * 60, i)
+            body = json.dumps([Dict(row) for row in rows])
+            seconds, status, data = Timed(self.port, "POST", "/api/observations/batch", body,
+                                          {"Content-Type": "application/json"})
+            Check(status, "/api/observations/batch")
+            latencies.append(seconds)
+            start += BATCH_SIZE * 60
+
+        elapsed = time.time() - begin
+        self.last = start
+        return Summary(latencies, elapsed,
+                       observations_per_second=round(batches * BATCH_SIZE / elapsed, 1))
+
+    def Ingest(self, clients, requests):
+        # Each client posts its own run of minutes, one observation a request
+        start = self.last + 60
+        latencies = list()
+        errors = list()
+
+        def client(index):
+            try:
+                first = start + index * requests * 60
+                for row in dataset.Observations(first, first + requests * 60, index):
+                    seconds, status, data = Timed(self.port, "POST",
+                            "/api/addobservation?durability=commit", json.dumps(Dict(row)),
+                            {"Content-Type": "application/json"})
+                    Check(status, "/api/addobservation")
+                    latencies.append(seconds)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        begin = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - begin
+        if errors:
+            raise errors[0]
+
+        self.last = start + clients * requests * 60
+        return Summary(latencies, elapsed, clients=clients)
+
+
+def Dict(row):
+    return dict(zip(("temp", "pres", "rhum", "lux", "alt", "time"), row))
+
+
+def Commit():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull,
+                    cwd=os.path.dirname(os.path.abspath(__file__))).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def Run(args):
+    tmpdir = tempfile.mkdtemp(prefix="weather-bench-")
+    try:
+        source = args.dataset or os.path.join(tmpdir, "dataset.db")
+        if not os.path.exists(source):
+            print("Generating {} years of observations into {}".format(args.years, source),
+                  file=sys.stderr)
+            dataset.Generate(source, args.years, args.seed)
+            # Closing checkpoints the WAL into the file copied below
+            CloseConnections()
+
+        # The benchmark writes, so it runs on a copy
+        dbfile = os.path.join(tmpdir, "Weather.db")
+        shutil.copy(source, dbfile)
+
+        import weather
+        weather.WeatherHistory.DBFILE = dbfile
+        import serve
+
+        wh = weather.WeatherHistory(None)
+        oldest = next(wh.IterObservations(_batch=1, _ascending=True))
+        first = oldest.rows()[0][5]
+        last = wh.NewestTimestamp()
+
+        server = make_server("127.0.0.1", 0, serve.app, ThreadingWSGIServer, QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        suite = Suite(server.server_address[1], first, last, args.seed)
+        scenarios = (
+            ("latest", lambda: suite.Latest(args.requests)),
+            ("range", lambda: suite.Range(args.requests // 5 or 1)),
+            ("full", lambda: suite.Full(args.full_runs)),
+            ("mixed", lambda: suite.Mixed(args.clients, args.duration)),
+            ("ingest_batch", lambda: suite.IngestBatch(args.requests // 25 or 1)),
+            ("ingest", lambda: suite.Ingest(args.clients, args.requests // args.clients or 1)),
+        )
+
+        results = dict()
+        try:
+            for name, scenario in scenarios:
+                if args.only and name not in args.only:
+                    continue
+                print("Running {}".format(name), file=sys.stderr)
+                results[name] = scenario()
+        finally:
+            server.shutdown()
+            serve.shutdown()
+
+        return {
+            "commit": Commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": int(time.time()),
+            "dataset": {"years": args.years, "seed": args.seed, "first": first, "last": last},
+            "parameters": {"requests": args.requests, "clients": args.clients,
+                           "duration": args.duration, "full_runs": args.full_runs},
+            "scenarios": results,
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def Compare(before, after):
+    # Prints the change in throughput and latency of every scenario run in
+    # both, higher is better for rates and worse for latencies
+    for name in sorted(set(before["scenarios"]) & set(after["scenarios"])):
+        old = before["scenarios"][name]
+        new = after["scenarios"][name]
+        for metric in ("per_second", "p50_ms", "p99_ms"):
+            if not old.get(metric) or new.get(metric) is None:
+                continue
+            change = new[metric] / float(old[metric]) - 1
+            worse = change < -TOLERANCE if metric == "per_second" else change > TOLERANCE
+            print("{:<14} {:<12} {:>12} {:>12} {:>+8.1%}{}".format(name, metric, old[metric],
+                    new[metric], change, "  regression" if worse else ""))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as before, open(sys.argv[3]) as after:
+            Compare(json.load(before), json.load(after))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="weather API benchmark suite")
+    parser.add_argument("--dataset", help="history database, generated if missing")
+    parser.add_argument("--years", type=float, default=dataset.DEFAULT_YEARS)
+    parser.add_argument("--seed", type=int, default=dataset.DEFAULT_SEED)
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS)
+    parser.add_argument("--clients", type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION)
+    parser.add_argument("--full-runs", type=int, default=DEFAULT_FULL_RUNS)
+    parser.add_argument("--only", nargs="+", help="scenarios to run")
+    args = parser.parse_args()
+
+    # The server prints as it goes, keep stdout for the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = Run(args)
+    finally:
+        sys.stdout = stdout
+
+    print(json.dumps(results, indent=2, sort_keys=True))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+    Synthetic observation history for benchmarks.
+
+    Generates one observation a minute over whole years, shaped like what
+    the station records: temperature follows the seasons and a diurnal
+    curve that flattens under cloud, pressure wanders slowly and dips as
+    weather fronts pass, which also bring cloud and a cooler spell behind
+    them, lux follows the sun's elevation and the cloud, humidity moves
+    against the temperature and altitude is derived from the pressure.
+
+    The same seed gives the same rows, so two runs of a benchmark read
+    the same data.
+
+    Usage: python -m bench.dataset <dbfile> [years] [seed]
+"""
+
+from __future__ import print_function
+
+import calendar
+import math
+import random
+import sys
+import time
+
+from weather import WeatherHistory, CloseConnections
+
+DEFAULT_YEARS = 2
+DEFAULT_SEED = 1
+
+# The history ends at midnight UTC on this date, so it does not depend on
+# when it was generated
+END = calendar.timegm((2017, 1, 1, 0, 0, 0))
+
+INTERVAL = 60
+LATITUDE = 51.5
+
+# Rows inserted per transaction
+CHUNK = 10000
+
+# Seconds between fronts on average, their effect reaches three widths
+# either side of the passage
+FRONT_SPACING = 4 * 86400
+FRONT_REACH = 3
+
+# Seconds the cool spell behind a front takes to fade, fronts are
+# dropped once it has faded for COOL_DECAYS of them
+COOL_DECAY = 2 * 86400
+COOL_DECAYS = 4
+
+DAY = 86400.0
+YEAR = 365.25 * DAY
+
+
+def Fronts(rng, start, end):
+    # (passage, pressure drop in Pa, width in seconds, cooling in C)
+    t = start - FRONT_SPACING
+    while t < end + FRONT_SPACING:
+        t += rng.expovariate(1.0 / FRONT_SPACING)
+        yield (t, rng.uniform(800, 2500), rng.uniform(6, 18) * 3600, rng.uniform(2, 6))
+
+
+def SunElevation(t):
+    # Sine of the sun's elevation, solar time taken as UTC
+    day = (t % YEAR) / DAY
+    hour = (t % DAY) / 3600.0
+    declination = math.radians(23.44) * math.sin(2 * math.pi * (284 + day) / 365.0)
+    latitude = math.radians(LATITUDE)
+    angle = math.radians(15 * (hour - 12))
+    return math.sin(latitude) * math.sin(declination) + \
+        math.cos(latitude) * math.cos(declination) * math.cos(angle)
+
+
+def Observations(start, end, seed=DEFAULT_SEED):
+    """
+        Yields observation rows, (temp, pres, rhum, lux, alt, time), one
+        every INTERVAL seconds from start up to end.
+    """
+    rng = random.Random(seed)
+    fronts = Fronts(random.Random(seed + 1), start, end)
+    upcoming = next(fronts)
+    active = list()
+
+    # Slow random walks pulled back to their means
+    pressure = 0.0
+    cloud = 0.4
+    noise = 0.0
+    for t in range(start, end, INTERVAL):
+        while upcoming[0] - FRONT_REACH * upcoming[2] <= t:
+            active.append(upcoming)
+            upcoming = next(fronts)
+        active = [f for f in active if t < f[0] + COOL_DECAYS * COOL_DECAY]
+
+        pressure += -pressure / (2 * DAY) * INTERVAL + rng.gauss(0, 12)
+        cloud += (0.4 - cloud) / (DAY / 2) * INTERVAL + rng.gauss(0, 0.01)
+        cloud = min(max(cloud, 0.0), 1.0)
+        noise = 0.98 * noise + rng.gauss(0, 0.05)
+
+        drop = frontCloud = cooling = 0.0
+        for passage, depth, width, cool in active:
+            x = (t - passage) / width
+            near = math.exp(-x * x) if abs(x) < FRONT_REACH else 0.0
+            drop += depth * near
+            frontCloud += near
+            behind = 1.0 / (1.0 + math.exp(-max(min(x, 50), -50)))
+            cooling += cool * (behind * math.exp(-max(0, t - passage) / COOL_DECAY) - 0.3 * near)
+        sky = min(cloud + frontCloud, 1.0)
+
+        season = -8 * math.cos(2 * math.pi * ((t % YEAR) / DAY - 20) / 365.25)
+        diurnal = 5 * (1 - 0.6 * sky) * math.cos(2 * math.pi * ((t % DAY) / 3600.0 - 15) / 24)
+        temp = 11 + season + diurnal - cooling + noise
+
+        pres = 101080 + pressure - drop + 100 * math.cos(4 * math.pi * ((t % DAY) / 3600.0 - 10) / 24) \
+            + rng.gauss(0, 10)
+
+        elevation = SunElevation(t)
+        lux = 110000 * elevation * (1 - 0.75 * sky) if elevation > 0 else 0.0
+        lux = min(lux * rng.uniform(0.97, 1.03), 40000)
+
+        rhum = 75 - 2.5 * diurnal + 15 * sky + rng.gauss(0, 1)
+        alt = 44330 * (1 - (pres / 101325.0) ** 0.1903)
+
+        yield (round(temp, 1), round(pres, 0), int(min(max(rhum, 5), 100)), round(lux, 1),
+               int(max(round(alt), 0)), t)
+
+
+def Generate(dbfile, years=DEFAULT_YEARS, seed=DEFAULT_SEED):
+    # Writes the history into dbfile and rebuilds its rollups, returns the
+    # number of rows written
+    wh = WeatherHistory(dbfile)
+    start = END - int(years * YEAR) // INTERVAL * INTERVAL
+    written = 0
+    chunk = list()
+    for row in Observations(start, END, seed):
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            wh.cur.executemany(wh.INSERT_OBSERVATION, chunk)
+            wh.conn.commit()
+            written += len(chunk)
+            chunk = list()
+    if chunk:
+        wh.cur.executemany(wh.INSERT_OBSERVATION, chunk)
+        wh.conn.commit()
+        written += len(chunk)
+
+    wh.RebuildRollups()
+    return written
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3, 4):
+        print("Usage: python -m bench.dataset <dbfile> [years] [seed]")
+        sys.exit(1)
+
+    years = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_YEARS
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_SEED
+
+    begin = time.time()
+    rows = Generate(sys.argv[1], years, seed)
+    CloseConnections()
+    print("Wrote {} observations to {} in {:.1f}s".format(rows, sys.argv[1], time.time() - begin))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+    Benchmark for the LCD controller, run headless on SimulatedDisplay.
+
+    Drives ObsLCD through simulated hours of a few keypad scripts and
+    reports, per simulated hour, how often the loop woke up, how many
+    times the display changed, the bytes sent to the display controller
+    and the CPU time spent, along with the average bytes per frame. The latest
+    observation is a fixed one, no API is contacted.
+
+    Usage: python -m bench.display [hours]
+"""
+
+from __future__ import print_function
+
+import os
+import resource
+import sys
+
+from lcd import ObsLCD, SimulatedDisplay, KEY2PIN, KEY3PIN, KEY4PIN
+
+DEFAULT_HOURS = 24
+
+LATEST = {"temp": 21.5, "pres": 101325.0, "rhum": 48, "lux": {"luxd": 820.0},
+          "alt": 20, "time": 1500000000}
+
+
+def Idle(hours):
+    # Nobody touches the keypad
+    return []
+
+
+def Browsing(hours):
+    # Dismiss the IP screen, then every two minutes wake the backlight and
+    # step to the next screen
+    keys = [(1, KEY4PIN)]
+    for t in range(120, hours * 3600, 120):
+        keys += [(t, KEY2PIN), (t + 1, KEY2PIN)]
+
+    return keys
+
+
+def Scrolling(hours):
+    # Dismiss the IP screen and leave the display scrolling
+    return [(1, KEY4PIN), (2, KEY3PIN)]
+
+
+SCENARIOS = (("idle", Idle), ("browsing", Browsing), ("scrolling", Scrolling))
+
+
+class FixedFetcher:
+    def Start(self, callback):
+        pass
+
+    def Stop(self):
+        pass
+
+    def Latest(self):
+        return LATEST
+
+
+class BenchLCD(ObsLCD):
+    def GetIP(self):
+        return "192.168.0.2"
+
+    def Frame(self):
+        return self._frame
+
+
+def CPUTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def Run(keys, hours):
+    display = SimulatedDisplay(keys)
+    lcd = BenchLCD(display, FixedFetcher())
+
+    # The state machine prints as it goes
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = CPUTime()
+        lcd.Setup()
+        while display.Now() < hours * 3600:
+            lcd.Loop()
+        cpu = CPUTime() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    frame = lcd.Frame()
+    return display.wakeups, frame.frames, frame.bytes, cpu
+
+
+if __name__ == "__main__":
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_HOURS
+
+    print("{:<10} {:>14} {:>14} {:>14} {:>14} {:>14}".format("scenario", "wakeups/hour",
+            "frames/hour", "bytes/hour", "bytes/frame", "cpu ms/hour"))
+    for name, script in SCENARIOS:
+        wakeups, frames, sent, cpu = Run(script(hours), hours)
+        print("{:<10} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.1f} {:>14.3f}".format(name,
+                wakeups / float(hours), frames / float(hours), sent / float(hours),
+                sent / float(max(frames, 1)), cpu * 1000.0 / hours))
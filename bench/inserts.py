@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+    Micro-benchmark for observation inserts.
+
+    Compares the original str.format path, which built a new SQL string per
+    row and checked it with sqlite3.complete_statement, against the bound
+    parameter path WeatherHistory uses now. Both are measured committing
+    every row, as AddObservation does, and inside a single transaction,
+    which isolates the cost of parsing and planning each statement.
+
+    Usage: python -m bench.inserts [rows]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from weather import WeatherHistory, CloseConnections
+
+FORMAT_INSERT = "INSERT INTO observations VALUES({}, {}, {}, {}, {}, {});"
+
+DEFAULT_ROWS = 5000
+
+
+def Rows(count, start):
+    for i in range(count):
+        yield (20.0 + (i % 50) / 10.0, 101325.0, 50, 1000.0, 20, start + i * 60)
+
+
+def FormatInsert(wh, rows, commit):
+    for row in rows:
+        sql = FORMAT_INSERT.format(*row)
+        if sqlite3.complete_statement(sql):
+            wh.cur.execute(sql)
+            if commit:
+                wh.conn.commit()
+    wh.conn.commit()
+
+
+def BoundInsert(wh, rows, commit):
+    for row in rows:
+        wh.cur.execute(wh.INSERT_OBSERVATION, row)
+        if commit:
+            wh.conn.commit()
+    wh.conn.commit()
+
+
+def Run(count):
+    tmpdir = tempfile.mkdtemp(prefix="weather-bench-")
+    results = list()
+    try:
+        start = 0
+        for commit in (True, False):
+            for name, insert in (("format", FormatInsert), ("bound", BoundInsert)):
+                dbfile = os.path.join(tmpdir, "{}-{}.db".format(name, commit))
+                wh = WeatherHistory(dbfile)
+
+                begin = time.time()
+                insert(wh, Rows(count, start), commit)
+                elapsed = time.time() - begin
+                start += count * 60
+
+                results.append((name, "per-row commit" if commit else "one transaction",
+                                count / elapsed))
+    finally:
+        CloseConnections()
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS
+
+    for name, mode, rate in Run(count):
+        print("{:<8} {:<16} {:>10.0f} inserts/sec".format(name, mode, rate))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+    Memory benchmark for the in-memory observation representations.
+
+    Builds the same rows as a list of WeatherObservation dicts (what the
+    API held before), a list of ObservationRecord and an ObservationColumns
+    batch, each in a fresh child process, and reports the growth in peak
+    resident memory.
+
+    Usage: python -m bench.memory [rows]
+"""
+
+from __future__ import print_function
+
+import resource
+import subprocess
+import sys
+
+from observation import WeatherObservation, ObservationRecord, ObservationColumns
+
+DEFAULT_ROWS = 1000000
+CHUNK = 10000
+
+REPRESENTATIONS = ("dicts", "records", "columns")
+
+
+def Rows(count):
+    for i in range(count):
+        yield (20.0 + (i % 50) / 10.0, 101325.0 + i % 7, 50 + i % 3, 1000.0 + i % 11, 20, 1500000000 + i * 60)
+
+
+def Chunks(count):
+    chunk = list()
+    for row in Rows(count):
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def Build(name, count):
+    if name == "dicts":
+        held = list()
+        for chunk in Chunks(count):
+            held.extend(WeatherObservation(row).getObservation() for row in chunk)
+    elif name == "records":
+        held = list()
+        for chunk in Chunks(count):
+            held.extend(ObservationRecord.fromRow(row) for row in chunk)
+    else:
+        held = ObservationColumns()
+        for chunk in Chunks(count):
+            held.extend(chunk)
+
+    return held
+
+
+def PeakKB():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def Measure(name, count):
+    # Runs in the child process, prints the peak growth in kilobytes
+    before = PeakKB()
+    held = Build(name, count)
+    print(PeakKB() - before, len(held))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        Measure(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS
+
+    for name in REPRESENTATIONS:
+        output = subprocess.check_output([sys.executable, "-m", "bench.memory",
+                "--child", name, str(count)])
+        kb = int(output.split()[-2])
+        print("{:<8} {:>10.1f} MB {:>8.0f} bytes/row".format(name, kb / 1024.0, kb * 1024.0 / count))
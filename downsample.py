@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+    Streaming downsamplers used to reduce a range of observations to a
+    fixed number of chart points.
+
+    Time range [start, end] is split into equal width buckets and each
+    sampler is fed (time, value) points in ascending time order, one at a
+    time, so a whole cursor can be reduced in a single pass while holding
+    at most two buckets of points.
+
+    lttb   - Largest-Triangle-Three-Buckets, keeps the point of each bucket
+             that forms the largest triangle with the point kept from the
+             previous bucket and the average of the next bucket. Preserves
+             the visual shape of the series.
+    minmax - Keeps the lowest and highest point of each bucket, so peaks
+             are never lost.
+"""
+
+MODES = ("lttb", "minmax")
+
+
+class Bucketer:
+    """
+        Maps a timestamp to the index of its bucket when [start, end] is
+        split into count equal buckets.
+    """
+
+    def __init__(self, start, end, count):
+        self._start = start
+        self._span = float(end - start + 1)
+        self._count = max(count, 1)
+
+    def Bucket(self, t):
+        return min(int((t - self._start) * self._count / self._span), self._count - 1)
+
+
+class MinMaxSampler:
+    def __init__(self, bucketer):
+        self._bucketer = bucketer
+        self._points = list()
+        self._bucket = None
+        self._low = None
+        self._high = None
+
+    def Add(self, t, value):
+        if value is None:
+            return
+
+        bucket = self._bucketer.Bucket(t)
+        if bucket != self._bucket:
+            self._Flush()
+            self._bucket = bucket
+            self._low = self._high = (t, value)
+        elif value < self._low[1]:
+            self._low = (t, value)
+        elif value > self._high[1]:
+            self._high = (t, value)
+
+    def Finish(self):
+        self._Flush()
+        return self._points
+
+    def _Flush(self):
+        if self._bucket is None:
+            return
+
+        # Emit the pair in time order, once if both are the same point
+        for point in sorted(set((self._low, self._high))):
+            self._points.append(list(point))
+
+
+class LTTBSampler:
+    def __init__(self, bucketer):
+        self._bucketer = bucketer
+        self._points = list()
+        self._current = list()
+        self._next = list()
+        self._nextBucket = None
+
+    def Add(self, t, value):
+        if value is None:
+            return
+
+        # The first point is always kept
+        if not self._points:
+            self._points.append((t, value))
+            return
+
+        bucket = self._bucketer.Bucket(t)
+        if self._nextBucket is None or bucket == self._nextBucket:
+            self._next.append((t, value))
+        else:
+            # The next bucket is complete, so the current one can be decided
+            self._Select(self._current, self._Average(self._next))
+            self._current = self._next
+            self._next = [(t, value)]
+
+        self._nextBucket = bucket
+
+    def Finish(self):
+        if self._current:
+            self._Select(self._current, self._Average(self._next))
+
+        # The last point is always kept, the rest of its bucket is decided
+        # against it
+        if self._next:
+            last = self._next[-1]
+            self._Select(self._next[:-1], last)
+            self._points.append(last)
+
+        return [list(point) for point in self._points]
+
+    def _Select(self, bucket, c):
+        if not bucket:
+            return
+
+        ax, ay = self._points[-1]
+        cx, cy = c
+        best = None
+        bestArea = -1
+        for point in bucket:
+            area = abs((ax - cx) * (point[1] - ay) - (ax - point[0]) * (cy - ay))
+            if area > bestArea:
+                best, bestArea = point, area
+
+        self._points.append(best)
+
+    @staticmethod
+    def _Average(bucket):
+        count = float(len(bucket))
+        return (sum(p[0] for p in bucket) / count, sum(p[1] for p in bucket) / count)
+
+
+def Downsample(rows, start, end, points, mode, names):
+    """
+        Reduces rows of (time, value, value, ...) in ascending time order
+        to about points points per series. names gives the series name of
+        each value column, returns a dict of name to [[time, value], ...].
+        Values are returned as floats, as ObservationRecord.fromRow reads
+        them, whatever type sqlite stored them as.
+    """
+    if mode == "lttb":
+        # The first and last points are kept outside of the buckets
+        bucketer = Bucketer(start, end, points - 2)
+        samplers = [LTTBSampler(bucketer) for name in names]
+    elif mode == "minmax":
+        # Each bucket contributes up to two points
+        bucketer = Bucketer(start, end, points // 2)
+        samplers = [MinMaxSampler(bucketer) for name in names]
+    else:
+        raise ValueError("Unknown downsample mode: {}".format(mode))
+
+    for row in rows:
+        t = row[0]
+        for i, sampler in enumerate(samplers):
+            value = row[i + 1]
+            sampler.Add(t, None if value is None else float(value))
+
+    series = dict()
+    for name, sampler in zip(names, samplers):
+        series[name] = sampler.Finish()
+
+    return series
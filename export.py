@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+    Columnar binary export of the observations table.
+
+    Formats:
+    parquet - Apache Parquet, requires pyarrow
+    arrow   - Arrow IPC file, requires pyarrow
+    struct  - Packed little-endian columns, always available
+
+    Struct file layout, every integer little-endian:
+        0   8s      magic "WXCOLS01"
+        8   uint32  format version, 1
+        12  uint32  number of columns
+        16  uint64  number of rows
+        24          one 32 byte descriptor per column:
+                        16s     column name, NUL padded
+                        8s      numpy dtype string, NUL padded ("<f4", "<i8")
+                        uint64  byte offset of the column data
+        ...         column data, each column contiguous, rows in ascending
+                    timestamp order, every column starting on a 64 byte
+                    boundary
+
+    Columns are temp, pres, rhum, lux and alt as <f4 and time as <i8, 28
+    bytes per observation. A column can be mapped without copying:
+
+        header = export.ReadStructHeader(path)
+        offset, dtype = header["columns"]["temp"]
+        temp = numpy.memmap(path, dtype=dtype, mode="r", offset=offset,
+                            shape=(header["rows"],))
+
+    MemmapStruct(path) does this for every column.
+
+    Usage: python export.py [--format parquet|arrow|struct] [--since N]
+                            [--until N] [--db dbfile] output
+"""
+
+from __future__ import print_function
+
+from array import array
+import shutil
+import struct
+import sys
+import tempfile
+
+from observation import ObservationColumns
+from weather import WeatherHistory
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ("parquet", "arrow", "struct")
+PYARROW_FORMATS = ("parquet", "arrow")
+
+CONTENT_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+    "struct": "application/octet-stream"
+}
+
+EXTENSIONS = {"parquet": "parquet", "arrow": "arrow", "struct": "wxcols"}
+
+STRUCT_MAGIC = b"WXCOLS01"
+STRUCT_VERSION = 1
+STRUCT_HEADER = struct.Struct("<8sIIQ")
+STRUCT_COLUMN = struct.Struct("<16s8sQ")
+STRUCT_ALIGN = 64
+
+# Column name, numpy dtype and struct format character of each column
+STRUCT_COLUMNS = (
+    ("temp", "<f4", "f"),
+    ("pres", "<f4", "f"),
+    ("rhum", "<f4", "f"),
+    ("lux", "<f4", "f"),
+    ("alt", "<f4", "f"),
+    ("time", "<i8", "q"),
+)
+
+
+class ExportError(Exception):
+    """
+        Raised when an export format cannot be written.
+    """
+
+
+def Available(fmt):
+    return fmt in FORMATS and (pyarrow is not None or fmt not in PYARROW_FORMATS)
+
+
+def Export(wh, fileobj, fmt="struct", since=None, until=None):
+    """
+        Writes the observations recorded after since and up to and including
+        until to fileobj in format fmt, reading the table in one streaming
+        pass. Returns the number of observations written.
+    """
+    if fmt not in FORMATS:
+        raise ExportError("Unknown export format: {}".format(fmt))
+    if not Available(fmt):
+        raise ExportError("The {} format requires pyarrow".format(fmt))
+
+    batches = wh.IterObservations(since, until, 5000, True)
+    if fmt == "struct":
+        return _WriteStruct(batches, fileobj)
+
+    return _WriteArrow(batches, fileobj, fmt)
+
+
+def _WriteStruct(batches, fileobj):
+    # Each column is spooled to its own temporary file during the single
+    # pass, then the header is written and the spools are copied after it
+    spools = [tempfile.TemporaryFile() for column in STRUCT_COLUMNS]
+    rows = 0
+    try:
+        for batch in batches:
+            rows += len(batch)
+            for spool, column, (name, dtype, code) in zip(spools, batch.columns(), STRUCT_COLUMNS):
+                spool.write(_Pack(column, code))
+
+        offsets = list()
+        offset = _Align(STRUCT_HEADER.size + STRUCT_COLUMN.size * len(STRUCT_COLUMNS))
+        header = STRUCT_HEADER.pack(STRUCT_MAGIC, STRUCT_VERSION, len(STRUCT_COLUMNS), rows)
+        for spool, (name, dtype, code) in zip(spools, STRUCT_COLUMNS):
+            header += STRUCT_COLUMN.pack(name.encode("ascii"), dtype.encode("ascii"), offset)
+            offsets.append(offset)
+            offset = _Align(offset + spool.tell())
+
+        fileobj.write(header)
+        written = len(header)
+        for spool, offset in zip(spools, offsets):
+            fileobj.write(b"\0" * (offset - written))
+            written = offset + spool.tell()
+            spool.seek(0)
+            shutil.copyfileobj(spool, fileobj)
+    finally:
+        for spool in spools:
+            spool.close()
+
+    return rows
+
+
+def _Pack(column, code):
+    # Little-endian bytes of a column in the struct format of its column
+    if code == "f":
+        packed = array("f", column)
+    elif column.itemsize == 8:
+        packed = column
+    else:
+        # array('l') is 32 bits on some platforms
+        return struct.pack("<{}q".format(len(column)), *column)
+
+    if sys.byteorder != "little":
+        packed = array(packed.typecode, packed)
+        packed.byteswap()
+
+    # array.tobytes is only in Python 3
+    return packed.tobytes() if hasattr(packed, "tobytes") else packed.tostring()
+
+
+def _Align(offset):
+    return (offset + STRUCT_ALIGN - 1) // STRUCT_ALIGN * STRUCT_ALIGN
+
+
+def _WriteArrow(batches, fileobj, fmt):
+    types = [pyarrow.float64()] * 5 + [pyarrow.int64()]
+    schema = pyarrow.schema([pyarrow.field(name, t) for name, t in zip(ObservationColumns.COLUMNS, types)])
+
+    if fmt == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(fileobj, schema)
+    else:
+        writer = pyarrow.RecordBatchFileWriter(fileobj, schema)
+
+    rows = 0
+    try:
+        for batch in batches:
+            rows += len(batch)
+            arrays = [pyarrow.array(column.tolist(), type=t) for column, t in zip(batch.columns(), types)]
+            record = pyarrow.RecordBatch.from_arrays(arrays, list(ObservationColumns.COLUMNS))
+
+            if fmt == "parquet":
+                writer.write_table(pyarrow.Table.from_batches([record]))
+            else:
+                writer.write_batch(record)
+    finally:
+        writer.close()
+
+    return rows
+
+
+def ReadStructHeader(path):
+    """
+        Returns {"rows": n, "columns": {name: (offset, dtype)}} from the
+        header of a struct format export.
+    """
+    with open(path, "rb") as f:
+        magic, version, count, rows = STRUCT_HEADER.unpack(f.read(STRUCT_HEADER.size))
+        if magic != STRUCT_MAGIC or version != STRUCT_VERSION:
+            raise ExportError("Not a version {} struct export: {}".format(STRUCT_VERSION, path))
+
+        columns = dict()
+        for i in range(count):
+            name, dtype, offset = STRUCT_COLUMN.unpack(f.read(STRUCT_COLUMN.size))
+            columns[name.rstrip(b"\0").decode("ascii")] = (offset, dtype.rstrip(b"\0").decode("ascii"))
+
+    return {"rows": rows, "columns": columns}
+
+
+def MemmapStruct(path):
+    # Dict of column name to a read-only numpy.memmap of a struct export
+    import numpy
+
+    header = ReadStructHeader(path)
+    columns = dict()
+    for name, (offset, dtype) in header["columns"].items():
+        if header["rows"] == 0:
+            columns[name] = numpy.zeros(0, dtype=dtype)
+        else:
+            columns[name] = numpy.memmap(path, dtype=dtype, mode="r", offset=offset,
+                                         shape=(header["rows"],))
+
+    return columns
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export weather observations")
+    parser.add_argument("output")
+    parser.add_argument("--format", choices=FORMATS, default="parquet" if pyarrow else "struct")
+    parser.add_argument("--since", type=int)
+    parser.add_argument("--until", type=int)
+    parser.add_argument("--db", default=None)
+    args = parser.parse_args()
+
+    wh = WeatherHistory(args.db)
+    try:
+        with open(args.output, "wb") as f:
+            rows = Export(wh, f, args.format, args.since, args.until)
+    except ExportError as e:
+        print(str(e))
+        sys.exit(2)
+
+    print("Exported {} observations to {}".format(rows, args.output))
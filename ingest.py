@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+    In-process ingest queue decoupling observation POSTs from the SQLite
+    commit.
+
+    Observations are validated on the request thread and queued, a single
+    writer thread stores them in groups, committing once every
+    FLUSH_INTERVAL seconds or FLUSH_ROWS observations, whichever comes
+    first. One writer per process means request threads never wait on
+    the database write lock and one fsync covers a whole group.
+
+    Durability modes, chosen per observation:
+    enqueue - Put returns as soon as the observation is queued. An
+              observation still queued when the process is killed without
+              Stop being called is lost.
+    commit  - Put returns once the group holding the observation has been
+              committed, with whether it was stored, a duplicate or in an
+              archived month.
+"""
+
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+from observation import InvalidObservationError, ValidateBatch
+from weather import WeatherHistory, WeatherDBError
+
+DURABILITY_MODES = ("enqueue", "commit")
+
+# Group commit limits
+FLUSH_INTERVAL = 0.05
+FLUSH_ROWS = 500
+
+# Put refuses observations beyond this many queued
+MAX_PENDING = 20000
+
+# A group that fails to commit is retried this many times, RETRY_DELAY
+# seconds apart, before its observations are dropped
+MAX_RETRIES = 5
+RETRY_DELAY = 1.0
+
+
+class QueueFullError(Exception):
+    """
+        Raised when an observation is put on a queue already holding
+        MAX_PENDING observations.
+    """
+
+
+class Ticket:
+    """
+        Outcome of an observation put in commit mode: "stored", "duplicate",
+        "archived" or "failed", None until its group has been committed.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.result = None
+
+    def Wait(self, _timeout=None):
+        # Returns the result, None if the timeout passed first
+        self._done.wait(_timeout)
+        return self.result
+
+    def _Set(self, result):
+        self.result = result
+        self._done.set()
+
+
+class IngestQueue:
+    def __init__(self, _dbfile=None, _interval=FLUSH_INTERVAL, _rows=FLUSH_ROWS,
+                 _maxPending=MAX_PENDING):
+        self._dbfile = _dbfile
+        self._interval = _interval
+        self._rows = _rows
+        self._maxPending = _maxPending
+
+        self._cond = threading.Condition()
+        self._pending = list()
+        self._writing = 0
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+
+        # Statistics, read with Stats()
+        self._committed = 0
+        self._groups = 0
+        self._dropped = 0
+        self._lag = 0.0
+
+    def Put(self, _obs, _durability="enqueue"):
+        """
+            Validates and queues one observation, raises
+            InvalidObservationError if it is invalid and QueueFullError
+            when the writer has fallen too far behind. Returns None in
+            enqueue mode and a Ticket to wait on in commit mode.
+        """
+        if _durability not in DURABILITY_MODES:
+            raise ValueError("Unknown durability mode: {}".format(_durability))
+
+        columns, errors, fields = ValidateBatch([_obs])
+        if errors:
+            raise InvalidObservationError(errors[0]["error"])
+
+        ticket = Ticket() if _durability == "commit" else None
+        with self._cond:
+            if self._stopping:
+                raise QueueFullError("The ingest queue is shutting down")
+            if len(self._pending) >= self._maxPending:
+                raise QueueFullError("{} observations already queued".format(len(self._pending)))
+
+            self._Start()
+            self._pending.append((columns.rows()[0], ticket, time.time()))
+            # Wake the writer to start a group, or to commit a full one
+            if len(self._pending) == 1 or len(self._pending) >= self._rows:
+                self._cond.notify_all()
+
+        return ticket
+
+    def Flush(self, _timeout=None):
+        # Waits until every observation queued so far has been committed,
+        # returns False if the timeout passed first
+        deadline = None if _timeout is None else time.time() + _timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._writing:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+        return True
+
+    def Stop(self, _timeout=10.0):
+        # Commits whatever is queued and stops the writer thread, Put
+        # refuses observations from here on
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+
+        if thread is not None:
+            thread.join(_timeout)
+
+    def Stats(self):
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "committed": self._committed,
+                "groups": self._groups,
+                "dropped": self._dropped,
+                "lag": self._lag
+            }
+
+    def _Start(self):
+        # The writer is started on first use, and again in a forked child
+        # where the parent's thread does not exist. Called holding _cond.
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+
+        if self._pid != os.getpid():
+            # Anything the parent had queued is the parent's to commit
+            self._pending = list()
+            self._writing = 0
+
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._Run, name="ingest")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _Run(self):
+        wh = WeatherHistory(self._dbfile)
+        while True:
+            group = self._NextGroup()
+            if group is None:
+                return
+
+            self._Commit(wh, group)
+
+    def _NextGroup(self):
+        # Blocks until a group is due, returns None once stopping with
+        # nothing left to write
+        with self._cond:
+            while not self._pending and not self._stopping:
+                self._cond.wait()
+
+            # Give the group until FLUSH_INTERVAL after its first
+            # observation to fill up
+            deadline = self._pending[0][2] + self._interval if self._pending else 0
+            while len(self._pending) < self._rows and not self._stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if not self._pending:
+                return None
+
+            group = self._pending[:self._rows]
+            del self._pending[:self._rows]
+            self._writing = len(group)
+            return group
+
+    def _Commit(self, wh, group):
+        rows = [row for row, ticket, queued in group]
+        results = None
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                results = wh.AddObservationRows(rows)
+                break
+            except WeatherDBError as e:
+                print("IngestQueue: commit of {} observations failed: {}".format(len(rows), e))
+                if attempt < MAX_RETRIES and not self._stopping:
+                    time.sleep(RETRY_DELAY)
+
+        with self._cond:
+            if results is None:
+                self._dropped += len(group)
+                results = ["failed"] * len(group)
+            else:
+                self._committed += len(group)
+                self._groups += 1
+                self._lag = time.time() - group[0][2]
+
+            self._writing = 0
+            self._cond.notify_all()
+
+        for (row, ticket, queued), result in zip(group, results):
+            if ticket is not None:
+                ticket._Set(result)
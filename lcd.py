@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
-from Adafruit_CharLCD import Adafruit_RGBCharLCD as rgblcd 
-import RPi.GPIO as gpio
+from __future__ import print_function
+
 from daemon import Daemon
 import requests
+import heapq
+import json
+import threading
 import time
 from datetime import datetime as dt
 import subprocess
@@ -30,7 +33,6 @@ KEY2PIN = 17
 KEY3PIN = 23
 KEY4PIN = 4
 
-FAST_LOOPDT = 1
 SLOW_LOOPDT = 300
 BACKLIGHT_TIMEOUT = 10
 
@@ -38,19 +40,35 @@ BACKLIGHT_TIMEOUT = 10
 DEGC = "\337C"
 
 # Message templates
-MSG_DEFAULT = "Temperature: {temp:.0f}" + DEGC + "\nHumidity: {rhum}%"
+MSG_DEFAULT = "Temperature: {temp:.0f}" + DEGC + "\nHumidity: {rhum:.0f}%"
 MSG_TIME = "Today is:\n{}"
 MSG_PRESSURE = "Pressure:\n{pres:.0f} hPa"
 MSG_LUX = "Lux level:\n {:.0f} lx"
 MSG_ALTITUDE = "Altitude: {alt:.0f}m"
 MSG_TIMESTAMP = "Observation at:\n{}"
 MSG_IP = "{}"
+MSG_NO_POINTS = "Latest Points\nNot Found!"
 
 NUM_MSG_STATES = 6
 
 SCROLL_TIME = 5
 
-LATEST_OBS_URL = "http://localhost/api/latest"
+# New observations are read from the API event stream as they are stored,
+# reconnecting from the last event id when the server ends the stream. In
+# local mode the database is waited on for up to POLL_TIMEOUT seconds at a
+# time instead.
+LATEST_STREAM_URL = "http://localhost/api/stream"
+POLL_TIMEOUT = 30
+
+# Seconds allowed to connect, and between reads of the stream, which sends
+# a heartbeat every 15 seconds
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 45
+
+# Failed fetches are retried after BACKOFF_MIN seconds, doubling up to
+# BACKOFF_MAX while they keep failing
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
 
 ERR_NO_POINTS = 0
 ERR_SHOW_IP = 1
@@ -66,6 +84,294 @@ STATE_TIMESTAMP = 6
 STATE_SCROLL = 7
 STATE_OTHER = 99
 
+class GPIODisplay:
+    """
+    Display and keypad backend driving the RGB character LCD and the 4 button
+    keypad over the Raspberry Pi GPIO pins. The hardware libraries are only
+    imported when this backend is created.
+    """
+
+    def __init__(self):
+        from Adafruit_CharLCD import Adafruit_RGBCharLCD as rgblcd
+        import RPi.GPIO as gpio
+
+        self._gpio = gpio
+        self._lcd = rgblcd(RSPIN, EPIN, D4PIN, D5PIN, D6PIN, D7PIN, LCD_COLUMNS, LCD_ROWS, RPIN, GPIN, BPIN)
+
+    def Now(self):
+        return time.time()
+
+    def Wait(self, event, timeout):
+        # Blocks until event is set or timeout seconds pass, forever if None
+        event.wait(timeout)
+
+    def SetupKeys(self, callback):
+        for pin in (KEY1PIN, KEY2PIN, KEY3PIN, KEY4PIN):
+            self._gpio.setup(pin, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
+            self._gpio.add_event_detect(pin, self._gpio.FALLING, callback=callback, bouncetime=500)
+
+    def Clear(self):
+        self._lcd.clear()
+
+    def SetCursor(self, column, row):
+        self._lcd.set_cursor(column, row)
+
+    def Write(self, text):
+        # text never holds a newline, so message writes it as is
+        self._lcd.message(text)
+
+    def Backlight(self, on):
+        mode = self._gpio.OUT if on else self._gpio.IN
+        for pin in (RPIN, GPIN, BPIN):
+            self._gpio.setup(pin, mode)
+
+    def Cleanup(self):
+        self._gpio.cleanup()
+
+
+class SimulatedDisplay:
+    """
+    In-memory display and keypad backend with a simulated clock, for running
+    ObsLCD off the Pi. Waits return at once with the clock moved on to the
+    deadline, or to the next scripted key press, which is delivered through
+    the keypad callback as the hardware would.
+
+    keys is a list of (time, pin) presses. Every write is kept in writes as
+    (time, column, row, text), wakeups counts the waits.
+    """
+
+    def __init__(self, keys=(), start=0.0):
+        self.now = start
+        self.keys = sorted(keys)
+        self.writes = list()
+        self.clears = 0
+        self.wakeups = 0
+        self.backlight = True
+        self.cells = [[" "] * LCD_COLUMNS for row in range(LCD_ROWS)]
+        self.cursor = (0, 0)
+        self._callback = None
+
+    def Now(self):
+        return self.now
+
+    def Wait(self, event, timeout):
+        self.wakeups += 1
+        if event.is_set():
+            return
+
+        deadline = None if timeout is None else self.now + timeout
+        if self.keys and (deadline is None or self.keys[0][0] <= deadline):
+            at, pin = self.keys.pop(0)
+            self.now = max(self.now, at)
+            self._callback(pin)
+        elif deadline is None:
+            raise RuntimeError("Waiting forever with no key presses left")
+        else:
+            self.now = deadline
+
+    def SetupKeys(self, callback):
+        self._callback = callback
+
+    def Screen(self):
+        return "\n".join("".join(row) for row in self.cells)
+
+    def Clear(self):
+        self.clears += 1
+        self.cells = [[" "] * LCD_COLUMNS for row in range(LCD_ROWS)]
+        self.cursor = (0, 0)
+
+    def SetCursor(self, column, row):
+        self.cursor = (column, row)
+
+    def Write(self, text):
+        column, row = self.cursor
+        self.writes.append((self.now, column, row, text))
+        for char in text:
+            if column < LCD_COLUMNS:
+                self.cells[row][column] = char
+            column += 1
+        self.cursor = (column, row)
+
+    def Backlight(self, on):
+        self.backlight = on
+
+    def Cleanup(self):
+        pass
+
+
+class Framebuffer:
+    """
+    Keeps what is on the display and turns each new message into the fewest
+    cursor moves and character writes that change the screen into it, so
+    nothing is cleared and unchanged cells are never rewritten.
+
+    Every cursor move, clear and character costs one byte sent to the
+    HD44780. bytes counts them all, frames the renders that changed
+    something and lastBytes the bytes of the latest render.
+    """
+
+    def __init__(self, display, columns=LCD_COLUMNS, rows=LCD_ROWS):
+        self._display = display
+        self._columns = columns
+        self._rows = rows
+        self._cells = None
+        self.frames = 0
+        self.bytes = 0
+        self.lastBytes = 0
+
+    def Render(self, message):
+        # Returns the number of bytes sent
+        lines = message.split("\n")[:self._rows]
+        lines += [""] * (self._rows - len(lines))
+        frame = [line[:self._columns].ljust(self._columns) for line in lines]
+
+        sent = 0
+        if self._cells is None:
+            # Contents unknown, start from a blank screen
+            self._display.Clear()
+            self._cells = [" " * self._columns] * self._rows
+            sent += 1
+
+        ops = list()
+        cursor = None
+        for row in range(self._rows):
+            for start, end in self._Runs(self._cells[row], frame[row]):
+                if cursor != (start, row):
+                    ops.append((start, row, None))
+                    sent += 1
+                ops.append((start, row, frame[row][start:end]))
+                sent += end - start
+                cursor = (end, row)
+
+        for column, row, text in ops:
+            if text is None:
+                self._display.SetCursor(column, row)
+            else:
+                self._display.Write(text)
+
+        self._cells = frame
+        self.lastBytes = sent
+        self.bytes += sent
+        if sent:
+            self.frames += 1
+
+        return sent
+
+    def Invalidate(self):
+        # The screen was changed behind our back, redraw it all next time
+        self._cells = None
+
+    @staticmethod
+    def _Runs(old, new):
+        # (start, end) of the cells that differ, runs one unchanged cell
+        # apart are joined since rewriting it costs no more than a move
+        runs = list()
+        for i in range(len(new)):
+            if old[i] == new[i]:
+                continue
+            if runs and i - runs[-1][1] <= 1:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1])
+
+        return runs
+
+
+class LatestFetcher:
+    """
+    Keeps the latest weather observation up to date from a background thread,
+    so the display loop never waits on the network or the database.
+
+    In http mode the API event stream is read over one keep-alive session.
+    In local mode the observation is read straight from the weather database
+    with WeatherHistory, for an LCD running on the same Pi as the API.
+    callback() is called from the fetcher thread whenever a new observation
+    arrives.
+    """
+
+    def __init__(self, local=False, url=LATEST_STREAM_URL, dbfile=None):
+        self._local = local
+        self._url = url
+        self._dbfile = dbfile
+        self._lastId = None
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def Start(self, callback):
+        self._callback = callback
+        self._thread = threading.Thread(target=self._Run, name="fetcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.set()
+
+    def Latest(self):
+        # Last observation fetched, {} until the first fetch succeeds
+        with self._lock:
+            return self._latest
+
+    def _Run(self):
+        fetch = self._Local() if self._local else self._Remote()
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                latest = next(fetch)
+                failures = 0
+            except Exception as e:
+                # Start again with a fresh session or connection
+                print("LatestFetcher: {}".format(e))
+                fetch = self._Local() if self._local else self._Remote()
+                self._stop.wait(min(BACKOFF_MIN * 2 ** failures, BACKOFF_MAX))
+                failures += 1
+                continue
+
+            if latest:
+                with self._lock:
+                    self._latest = latest
+                self._callback()
+
+    def _Remote(self):
+        # Yields each observation event of the stream, resuming after the
+        # last one received when the stream is opened again
+        session = requests.Session()
+        while True:
+            headers = dict()
+            if self._lastId is not None:
+                headers["Last-Event-ID"] = self._lastId
+
+            r = session.get(self._url, headers=headers, stream=True,
+                            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            try:
+                r.raise_for_status()
+                data = None
+                # Read a byte at a time, larger reads wait for the chunk to fill
+                for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+                    if line.startswith("id:"):
+                        self._lastId = line[3:].strip()
+                    elif line.startswith("data:"):
+                        data = line[5:].strip()
+                    elif not line and data:
+                        yield json.loads(data)
+                        data = None
+            finally:
+                r.close()
+
+    def _Local(self):
+        from weather import WeatherHistory
+        import live
+
+        wh = WeatherHistory(self._dbfile)
+        since = wh.MIN_TIMESTAMP
+        while True:
+            observations = live.Wait(wh, since, POLL_TIMEOUT)
+            if observations:
+                since = observations[-1]["time"]
+            yield observations[-1] if observations else None
+
+
 class ObsLCD:
     """
     Class to represent the LCD and 4 button keypad used to get realtime feed back
@@ -80,95 +386,144 @@ class ObsLCD:
     5 - Altitude
     6 - Timestamp
     7 - Scroll
+
+    The display and keypad are reached through a backend, GPIODisplay unless
+    another is given, which also provides the clock. Observations come from
+    fetcher, an HTTP LatestFetcher unless another is given.
     """
 
+    def __init__(self, display=None, fetcher=None):
+        self._display = display
+        self._fetcher = fetcher
+
     def Run(self):
         try:
             self.Setup()
 
-            self.x = time.time() + 300
-            print self.x
             while True:
-                if self.x < time.time():
-                    print "here1"
-                    
-                    sys.exit()
                 self.Loop()
         except KeyboardInterrupt:
             pass
         finally:
-            gpio.cleanup()
+            self._fetcher.Stop()
+            self._display.Cleanup()
 
     def Setup(self):
-        self._lcd = rgblcd(RSPIN, EPIN, D4PIN, D5PIN, D6PIN, D7PIN, LCD_COLUMNS, LCD_ROWS, RPIN, GPIN, BPIN)
-        self._bltimeout = time.time() + BACKLIGHT_TIMEOUT
+        if self._display is None:
+            self._display = GPIODisplay()
+        if self._fetcher is None:
+            self._fetcher = LatestFetcher()
+        self._bltimeout = self.Now() + BACKLIGHT_TIMEOUT
         self._lcdon = True
-        self._laststate = STATE_OTHER
         self._state = STATE_ERROR
         self._error = ERR_SHOW_IP
         self._errAck = False
         
         self._latest = {}
 
-        # Loop timing
-        self._slowtime = time.time()
-        self._fasttime = time.time()
+        # Timer deadlines by name, the heap holds (deadline, name) and
+        # entries whose deadline has since changed are skipped. _wake is
+        # set by the keypad and fetcher callbacks to end the wait early.
+        self._deadlines = dict()
+        self._timers = list()
+        self._wake = threading.Event()
+        self._fetched = False
+
+        self._frame = Framebuffer(self._display)
 
         # Setup keypad 
-        for pin in (KEY1PIN, KEY2PIN, KEY3PIN, KEY4PIN):
-            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        self._keys = list()
+        self._display.SetupKeys(self.Callback)
+        self._fetcher.Start(self.Fetched)
 
-        gpio.add_event_detect(KEY1PIN, gpio.FALLING, callback=self.Callback, bouncetime=500)
-        gpio.add_event_detect(KEY2PIN, gpio.FALLING, callback=self.Callback, bouncetime=500)
-        gpio.add_event_detect(KEY3PIN, gpio.FALLING, callback=self.Callback, bouncetime=500)
-        gpio.add_event_detect(KEY4PIN, gpio.FALLING, callback=self.Callback, bouncetime=500)
+        self._msgIP = MSG_IP.format(self.GetIP())
 
-        self._keys = list()
-        self._msgIP = MSG_IP.format(subprocess.check_output('./ip.sh'))
+        # Shown until the first observation has been fetched
+        self._msgError = MSG_NO_POINTS
+        self._msgDefault = self._msgPres = self._msgLux = MSG_NO_POINTS
+        self._msgAlt = self._msgTimestamp = MSG_NO_POINTS
 
-        self._scrolltime = time.time()
+        self._scrolltime = self.Now()
 
         self._message = STATE_ERROR
-        self.SetupMessages()
+        self.Schedule("refresh", self.Now())
 
     def Loop(self):
-        ###################
-        # Fast loop
-        if self._fasttime <= time.time():
-            # Update our time display to the current time
-            self._msgTime = MSG_TIME.format(dt.today().strftime('%d-%m-%y : %H:%M'))
-            
-            # Process key input
-            self.ProcessKeys()
-
-            # Update display with message based on state
-            self.ProcessState()
-
-            # If our state has changed we need to display the new message
-            if self._laststate != self._state:
-                self.DisplayMessage()
-
-            # Check LCD timout if the lcd is currently on
-            if self._lcdon:
-                if self._bltimeout < time.time():
-                    self.ToggleBacklight()
-            
-            # Save our current state as the last state. This lets
-            # us avoid rendering if we dont change state next loop
-            self._laststate = self._state
-
-            # Add the Delta time for our fast loop
-            self._fasttime += FAST_LOOPDT
-
-        #################
-        # Slow loop
-        if self._slowtime <= time.time():
-            # Update messages with the lastest weather observation data point
-            self.SetupMessages()
-
-            # Add the Delta time for our slow loop
-            self._slowtime += SLOW_LOOPDT
-            
+        # Sleeps until the next timer is due or a key is pressed, then
+        # runs whatever is due
+        self.Wait(self._timers[0][0] - self.Now() if self._timers else None)
+        self._wake.clear()
+
+        if self._fetched:
+            self._fetched = False
+            self.Refresh()
+
+        if self._keys:
+            self.Update()
+
+        while self._timers and self._timers[0][0] <= self.Now():
+            deadline, name = heapq.heappop(self._timers)
+            if self._deadlines.get(name) != deadline:
+                continue
+
+            del self._deadlines[name]
+            if name == "refresh":
+                self.Refresh()
+            elif name == "update":
+                self.Update()
+
+    def Now(self):
+        return self._display.Now()
+
+    def Wait(self, timeout):
+        # Blocks for up to timeout seconds, forever if None
+        self._display.Wait(self._wake, None if timeout is None else max(timeout, 0))
+
+    def Schedule(self, name, deadline):
+        # Sets the deadline of the named timer, replacing any earlier one
+        self._deadlines[name] = deadline
+        heapq.heappush(self._timers, (deadline, name))
+
+    def Refresh(self):
+        # Update messages with the lastest weather observation data point
+        self.SetupMessages()
+        self.Schedule("refresh", self.Now() + SLOW_LOOPDT)
+        self.Update()
+
+    def Update(self):
+        # Update our time display to the current time
+        self._msgTime = MSG_TIME.format(dt.today().strftime('%d-%m-%y : %H:%M'))
+
+        # Process key input
+        self.ProcessKeys()
+
+        # Update display with message based on state
+        self.ProcessState()
+
+        # Only cells that differ from the screen are written, so an
+        # unchanged message costs nothing
+        self.DisplayMessage()
+
+        # Check LCD timout if the lcd is currently on
+        if self._lcdon:
+            if self._bltimeout <= self.Now():
+                self.ToggleBacklight()
+
+        self.Schedule("update", self.NextUpdate())
+
+    def NextUpdate(self):
+        # The display next needs updating when the clock reaches the next
+        # minute, the backlight times out or the scroll moves on
+        now = self.Now()
+        deadlines = [(int(now) // 60 + 1) * 60]
+        if self._lcdon:
+            deadlines.append(self._bltimeout)
+        if self._state == STATE_SCROLL:
+            deadlines.append(self._scrolltime)
+
+        return max(min(deadlines), now)
+
+
     def SetupMessages(self):
         '''
         1 - MSG_DEFAULT = "Temperature: {}" + DEGC + "\nHumidity: {}%"
@@ -186,12 +541,11 @@ class ObsLCD:
             self._msgAlt = MSG_ALTITUDE.format(**self._latest)
             self._msgTimestamp = MSG_TIMESTAMP.format(" ".join(dt.fromtimestamp(self._latest['time']).isoformat().split('T')))
         else:
-            self._msgError = "Latest Points\nNot Found!"
+            self._msgError = MSG_NO_POINTS
             self._state = STATE_ERROR
 
     def DisplayMessage(self):
-        self._lcd.clear()
-        self._lcd.message(self._message)
+        self._frame.Render(self._message)
 
     def ProcessState(self):
         if self._state == STATE_ERROR:
@@ -208,7 +562,7 @@ class ObsLCD:
                 elif self._error == ERR_SHOW_IP:
                     self._error = ERR_NO_ERROR
 
-                self.errAck = False
+                self._errAck = False
         elif self._state == STATE_DEFAULT:
             self._message = self._msgDefault
         elif self._state == STATE_TIME:
@@ -224,14 +578,13 @@ class ObsLCD:
         elif self._state == STATE_SCROLL:
             # If current screen has been displayed for
             # SCROLL_TIME swap to the next one
-            if self._scrolltime < time.time():
+            if self._scrolltime <= self.Now():
                 self._scroll += 1
-                print self._scroll
+                print(self._scroll)
                 if self._scroll > NUM_MSG_STATES:
                     self._scroll = STATE_DEFAULT
                 self._scrolltime += SCROLL_TIME
-                self._laststate = STATE_OTHER 
-                self._bltimeout = time.time() + BACKLIGHT_TIMEOUT
+                self._bltimeout = self.Now() + BACKLIGHT_TIMEOUT
 
                 # Update self._message to the newly scrolled to message
                 if self._scroll == STATE_DEFAULT:
@@ -247,15 +600,13 @@ class ObsLCD:
                 elif self._scroll == STATE_TIMESTAMP:
                     self._message = self._msgTimestamp
 
-                print self._message
+                print(self._message)
 
-    def GetLatest(self):
-        r = requests.get(LATEST_OBS_URL)
+    def GetIP(self):
+        return subprocess.check_output('./ip.sh')
 
-        if r.status_code == 200:
-            self._latest = r.json() 
-        else:
-            self._latest = {}
+    def GetLatest(self):
+        self._latest = self._fetcher.Latest()
 
     def ProcessKeys(self):
         if len(self._keys) > 0:
@@ -267,7 +618,7 @@ class ObsLCD:
             else:
                 # Process each key that has been pressed
                 for key in self._keys:
-                    print key
+                    print(key)
                     if key == KEY1PIN:
                         if self._state == STATE_DEFAULT:
                             self._state = NUM_MSG_STATES
@@ -281,33 +632,37 @@ class ObsLCD:
                     elif key == KEY3PIN:
                         # Set scrolltime to now, set the scroll state and 
                         # reset the scroll screen
-                        self._scrolltime = time.time()
+                        self._scrolltime = self.Now()
                         self._state = STATE_SCROLL
                         self._scroll = 0
                     elif key == KEY4PIN:
                         self._errAck = True
 
             # Update backlight timeout if a key was pressed
-            self._bltimeout = time.time() + BACKLIGHT_TIMEOUT
+            self._bltimeout = self.Now() + BACKLIGHT_TIMEOUT
 
         self._keys=[]
 
     def ToggleBacklight(self):
-        if self._lcdon:
-            gpio.setup(RPIN, gpio.IN)
-            gpio.setup(GPIN, gpio.IN)
-            gpio.setup(BPIN, gpio.IN)
-        else:
-            gpio.setup(RPIN, gpio.OUT)
-            gpio.setup(GPIN, gpio.OUT)
-            gpio.setup(BPIN, gpio.OUT)
+        self._display.Backlight(not self._lcdon)
         self._lcdon = not self._lcdon
 
     def Callback(self, pin):
+        # Runs on the GPIO event thread
         self._keys.append(pin)
+        self._wake.set()
+
+    def Fetched(self):
+        # Runs on the fetcher thread when a new observation has arrived
+        self._fetched = True
+        self._wake.set()
 
 if __name__ == "__main__":
-    lcd = ObsLCD()
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "local":
+        # Read the weather database directly instead of the API
+        lcd = ObsLCD(fetcher=LatestFetcher(True, dbfile=sys.argv[2] if len(sys.argv) == 3 else None))
+    else:
+        lcd = ObsLCD()
     lcd.Run()
 
 #        daemon = lcd('/tmp/lcd-daemon.pid')
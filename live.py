@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+    Live feed of newly stored observations, behind /api/stream.
+
+    WeatherHistory publishes every observation it stores to FEED, which
+    keeps the most recent BUFFER_SIZE of them and wakes every waiting
+    subscriber, so a reading reaches open streams within milliseconds of
+    its commit without anyone polling.
+
+    The feed only sees observations stored by its own process. Where
+    several processes write, for example uWSGI workers, Wait also checks
+    the database every CHECK_INTERVAL seconds. The check is served from
+    the latest observation cache and costs one PRAGMA unless something
+    was stored.
+
+    Subscribers track the timestamp of the last observation they have
+    seen, which is also the Server-Sent Events id, so a client that
+    reconnects with Last-Event-ID is sent what it missed.
+"""
+
+import collections
+import json
+import threading
+import time
+
+from observation import Project
+
+BUFFER_SIZE = 256
+
+# Seconds between database checks for observations stored by other processes
+CHECK_INTERVAL = 1.0
+
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT = 15.0
+
+# Milliseconds an EventSource waits before reconnecting
+RETRY = 3000
+
+# Most observations replayed to a reconnecting subscriber
+REPLAY_LIMIT = 500
+
+
+class LiveFeed:
+    def __init__(self, _size=BUFFER_SIZE):
+        self._cond = threading.Condition()
+        self._buffer = collections.deque(maxlen=_size)
+        self._listeners = list()
+
+    def Publish(self, _observations):
+        # Called with the API dicts of newly committed observations
+        with self._cond:
+            self._buffer.extend(_observations)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            listener()
+
+    def Since(self, _since):
+        # Buffered observations newer than _since, oldest first
+        with self._cond:
+            observations = [obs for obs in self._buffer if obs["time"] > _since]
+
+        return sorted(observations, key=lambda obs: obs["time"])
+
+    def Wait(self, _since, _timeout):
+        # Blocks until an observation newer than _since is published or
+        # _timeout seconds have passed, returns the newer observations
+        deadline = time.time() + _timeout
+        with self._cond:
+            while not any(obs["time"] > _since for obs in self._buffer):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+        return self.Since(_since)
+
+    def Listen(self, _listener):
+        # _listener() is called from the publishing thread after every
+        # publish, for subscribers that cannot block on Wait
+        with self._cond:
+            self._listeners.append(_listener)
+
+    def Unlisten(self, _listener):
+        with self._cond:
+            self._listeners.remove(_listener)
+
+
+FEED = LiveFeed()
+
+
+def Replay(wh, since, fields=None):
+    """
+        Observations stored after since, oldest first and at most
+        REPLAY_LIMIT of the newest. With since None only the latest
+        observation is returned. fields narrows the observations.
+    """
+    if since is None:
+        latest = wh.LatestObservation(fields)
+        return [latest] if latest else []
+
+    observations, cursor = wh.LoadObservationPage(since, None, REPLAY_LIMIT, _fields=fields)
+    return list(reversed(list(observations.toDicts(fields))))
+
+
+def Wait(wh, since, timeout, fields=None):
+    """
+        Blocks until observations newer than since are stored, by this or
+        any other process, or timeout seconds have passed. Returns them
+        oldest first, narrowed to fields.
+    """
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        observations = FEED.Wait(since, max(0, min(remaining, CHECK_INTERVAL)))
+        if observations:
+            return [Project(obs, fields) for obs in observations]
+
+        latest = wh.LatestObservation()
+        if latest and latest["time"] > since:
+            return Replay(wh, since, fields)
+
+        if remaining <= CHECK_INTERVAL:
+            return []
+
+
+def Event(obs):
+    return "id: {}\nevent: observation\ndata: {}\n\n".format(obs["time"], json.dumps(obs))
+
+
+def Heartbeat():
+    return ": keep-alive\n\n"
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+    In-process metrics, exposed at /api/metrics in the Prometheus text
+    format.
+
+    Counters and histograms are kept in REGISTRY per process, gauges are
+    read from their callback when the metrics are rendered. Under uWSGI
+    every worker keeps its own, a scrape sees the worker that answered it.
+
+    Instrument wraps the WSGI app to count and time requests by route. A
+    request can also be profiled with cProfile, by sending X-Profile: 1
+    or ?profile=1, when the WEATHER_PROFILE_DIR environment variable
+    names a directory, set with env in uwsgi.ini under uWSGI. The stats
+    are dumped there, one file per request, named in the X-Profile-Dump
+    response header.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Directory profiles are written to, profiling is refused while None
+PROFILE_DIR = os.environ.get("WEATHER_PROFILE_DIR") or None
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = dict()
+        self._counters = dict()
+        self._histograms = dict()
+        self._gauges = list()
+
+    def Describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def Inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def Observe(self, name, seconds, labels=()):
+        # Counts seconds into the histogram, the list holds a count per
+        # bucket, the +Inf bucket and the sum
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def Gauge(self, name, text, callback):
+        # callback() returns a list of (labels, value) when rendered
+        self.Describe(name, "gauge", text)
+        self._gauges.append((name, callback))
+
+    def Value(self, name, labels=()):
+        with self._lock:
+            return self._counters.get((name, tuple(labels)), 0)
+
+    def Series(self, name):
+        # Labels of every series of the named counter
+        with self._lock:
+            return [labels for key, labels in self._counters if key == name]
+
+    def Render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        lines = list()
+        described = set()
+
+        def describe(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append("# HELP {} {}".format(name, text))
+                lines.append("# TYPE {} {}".format(name, kind))
+            described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append("{}{} {}".format(name, _Labels(labels), _Number(value)))
+
+        for (name, labels), histogram in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                le = labels + (("le", bound if bound == "+Inf" else repr(bound)),)
+                lines.append("{}_bucket{} {}".format(name, _Labels(le), cumulative))
+            lines.append("{}_sum{} {}".format(name, _Labels(labels), _Number(histogram[-1])))
+            lines.append("{}_count{} {}".format(name, _Labels(labels), cumulative))
+
+        for name, callback in self._gauges:
+            describe(name)
+            for labels, value in callback():
+                lines.append("{}{} {}".format(name, _Labels(tuple(labels)), _Number(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+def _Labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join("{}=\"{}\"".format(name, _Escape(value)) for name, value in labels) + "}"
+
+
+def _Escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _Number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+REGISTRY.Describe("weather_http_requests_total", "counter", "HTTP requests answered, by route, method and status.")
+REGISTRY.Describe("weather_http_request_duration_seconds", "histogram",
+                  "Time to the first byte of the response, by route.")
+REGISTRY.Describe("weather_sql_duration_seconds", "histogram", "SQLite statement execution time, by statement.")
+REGISTRY.Describe("weather_sql_rows_read_total", "counter", "Rows returned by SQLite, by statement.")
+REGISTRY.Describe("weather_sql_rows_written_total", "counter", "Rows changed by SQLite, by statement.")
+REGISTRY.Describe("weather_cache_requests_total", "counter", "Cache lookups, by cache and hit or miss.")
+
+
+def Cache(cache, hit):
+    REGISTRY.Inc("weather_cache_requests_total", (("cache", cache), ("result", "hit" if hit else "miss")))
+
+
+def CacheRatios():
+    # Hit ratio of every cache that has been used
+    ratios = list()
+    caches = set(dict(labels)["cache"] for labels in REGISTRY.Series("weather_cache_requests_total"))
+    for cache in sorted(caches):
+        hits = REGISTRY.Value("weather_cache_requests_total", (("cache", cache), ("result", "hit")))
+        misses = REGISTRY.Value("weather_cache_requests_total", (("cache", cache), ("result", "miss")))
+        ratios.append(((("cache", cache),), hits / float(hits + misses) if hits + misses else 0.0))
+
+    return ratios
+
+
+REGISTRY.Gauge("weather_cache_hit_ratio", "Share of cache lookups that were hits, by cache.", CacheRatios)
+
+
+def SQL(statement, seconds, read=0, written=0):
+    labels = (("statement", statement),)
+    REGISTRY.Observe("weather_sql_duration_seconds", seconds, labels)
+    if read:
+        REGISTRY.Inc("weather_sql_rows_read_total", labels, read)
+    if written:
+        REGISTRY.Inc("weather_sql_rows_written_total", labels, written)
+
+
+class Instrument:
+    """
+        WSGI middleware counting and timing every request by the Bottle
+        route that answered it.
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    def __call__(self, environ, start_response):
+        status = ["500"]
+
+        def start(code, headers, exc_info=None):
+            status[0] = code.split(" ", 1)[0]
+            if "weather.profile" in environ:
+                headers = headers + [("X-Profile-Dump", environ["weather.profile"])]
+            return start_response(code, headers, exc_info)
+
+        profile = self._Profiling(environ)
+        start_time = time.time()
+        try:
+            if profile:
+                result = self._Profile(environ, start, profile)
+            else:
+                result = self._app(environ, start)
+        finally:
+            route = environ.get("bottle.route")
+            rule = route.rule if route is not None else "unmatched"
+            REGISTRY.Observe("weather_http_request_duration_seconds", time.time() - start_time,
+                             (("route", rule),))
+            REGISTRY.Inc("weather_http_requests_total", (("route", rule),
+                         ("method", environ.get("REQUEST_METHOD", "")), ("status", status[0])))
+
+        return result
+
+    @staticmethod
+    def _Profiling(environ):
+        if PROFILE_DIR is None:
+            return None
+
+        query = environ.get("QUERY_STRING", "")
+        if environ.get("HTTP_X_PROFILE") == "1" or "profile=1" in query.split("&"):
+            return os.path.join(PROFILE_DIR, "{:.6f}-{}.prof".format(time.time(), os.getpid()))
+
+        return None
+
+    def _Profile(self, environ, start, path):
+        import cProfile
+
+        environ["weather.profile"] = os.path.basename(path)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self._app, environ, start)
+        finally:
+            if not os.path.isdir(PROFILE_DIR):
+                os.makedirs(PROFILE_DIR)
+            profiler.dump_stats(path)
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
+from array import array
 import json
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Defined ranges that observations can fall into, If an
 # observation falls outside of this range it will be set to 0
 MIN_TEMPERATURE = -10
@@ -19,6 +27,41 @@ MAX_LUX = 40000
 MIN_ALTITUDE = 0
 MAX_ALTITUDE = 10000
 
+try:
+    NUMBER_TYPES = (int, long, float)
+except NameError:
+    NUMBER_TYPES = (int, float)
+
+NAN = float("nan")
+
+# Bounds applied to whole columns by ClampColumns
+COLUMN_BOUNDS = (
+    ("temp", MIN_TEMPERATURE, MAX_TEMPERATURE),
+    ("pres", MIN_PRESSURE, MAX_PRESSURE),
+    ("rhum", MIN_HUMIDITY, MAX_HUMIDITY),
+    ("lux", MIN_LUX, MAX_LUX),
+    ("alt", MIN_ALTITUDE, MAX_ALTITUDE),
+)
+
+# Array typecode for timestamp columns, 'q' (64 bit) where the array module
+# supports it and the platform long otherwise
+try:
+    array('q')
+    TIMESTAMP_TYPECODE = 'q'
+except ValueError:
+    TIMESTAMP_TYPECODE = 'l'
+
+# Timestamps accepted, those the timestamp columns can hold. sqlite stores
+# 64 bits but the platform long is only 32 bits on 32-bit ARM on Python 2.
+MIN_TIMESTAMP = -2**(array(TIMESTAMP_TYPECODE).itemsize * 8 - 1)
+MAX_TIMESTAMP = 2**(array(TIMESTAMP_TYPECODE).itemsize * 8 - 1) - 1
+
+class InvalidObservationError(ValueError):
+    """
+        Raised when an observation is missing its timestamp or holds values
+        that are not numbers.
+    """
+
 class WeatherObservation:
     """
         Represents a weather object with Temperature, Barametric Pressure,
@@ -88,7 +131,7 @@ class WeatherObservation:
             _obs = _dict
 
         if type(_obs) == dict:
-            for key, value in _obs.iteritems():
+            for key, value in _obs.items():
                 if( key in self.OBSERVATION_TYPE ):
                     # Check all values fall within our bounds and truncate
                     # to sensible decimal places
@@ -120,6 +163,247 @@ class WeatherObservation:
 
                     self._observation[key] = value
                 else:
-                    print "unused key: " + key
+                    print("unused key: " + key)
         else:
-            return False, "Unknown format"    
+            return False, "Unknown format"
+
+
+class ObservationRecord(object):
+    """
+        Compact, slotted form of a single stored observation. Holds the six
+        column values only, the nested API dict is built on demand by
+        toDict so it never has to be kept in memory.
+    """
+
+    __slots__ = ("temp", "pres", "rhum", "lux", "alt", "time")
+
+    def __init__(self, temp, pres, rhum, lux, alt, time):
+        self.temp = temp
+        self.pres = pres
+        self.rhum = rhum
+        self.lux = lux
+        self.alt = alt
+        self.time = time
+
+    @classmethod
+    def fromRow(cls, row):
+        # Row tuple in observations table column order. Values are read as
+        # ObservationColumns holds them, floats and an integer time, so an
+        # observation serialises the same from sqlite rows and from arrays.
+        # Columns left out of a projection are None.
+        values = [None if value is None else float(value) for value in row[:5]]
+        return cls(*values + [int(row[5])])
+
+    def toRow(self):
+        return (self.temp, self.pres, self.rhum, self.lux, self.alt, self.time)
+
+    def toDict(self, fields=None):
+        # Same shape as WeatherObservation.getObservation, narrowed to
+        # fields and the time when they are given
+        if fields is not None:
+            observation = {"time": self.time}
+            for name in fields:
+                value = getattr(self, name)
+                observation[name] = {"luxd": value, "ambient": 0, "infrared": 0} if name == "lux" else value
+            return observation
+
+        return {
+            "temp": self.temp,
+            "pres": self.pres,
+            "rhum": self.rhum,
+            "lux": {"luxd": self.lux, "ambient": 0, "infrared": 0},
+            "alt": self.alt,
+            "time": self.time,
+            "raw": self.toRow()
+        }
+
+
+class ObservationColumns(object):
+    """
+        Columnar batch of observations with one typed array per field,
+        8 bytes per value instead of a dict per row. Rows are appended in
+        observations table column order and read back as records or API
+        dicts.
+    """
+
+    COLUMNS = ("temp", "pres", "rhum", "lux", "alt", "time")
+
+    def __init__(self, rows=()):
+        self.temp = array('d')
+        self.pres = array('d')
+        self.rhum = array('d')
+        self.lux = array('d')
+        self.alt = array('d')
+        self.time = array(TIMESTAMP_TYPECODE)
+
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.time)
+
+    def columns(self):
+        return [getattr(self, name) for name in self.COLUMNS]
+
+    def append(self, row):
+        for column, value in zip(self.columns(), row):
+            column.append(value)
+
+    def extend(self, rows):
+        # Converts each column with a single array extend from a list,
+        # missing values are stored as NaN for ClampColumns to reject
+        rows = list(rows)
+        for i, column in enumerate(self.columns()):
+            if column.typecode == 'd':
+                column.extend([NAN if row[i] is None else row[i] for row in rows])
+            else:
+                column.extend([row[i] for row in rows])
+
+    def rows(self):
+        return list(zip(*self.columns()))
+
+    def records(self):
+        for row in self.rows():
+            yield ObservationRecord(*row)
+
+    def toDicts(self, fields=None):
+        for record in self.records():
+            yield record.toDict(fields)
+
+
+def ParseFields(text):
+    """
+        Parses the comma separated observation fields of a fields= API
+        parameter. Returns None, meaning every field, when text is empty
+        and raises ValueError for unknown fields or when text names none.
+    """
+    if not text:
+        return None
+
+    fields = [field.strip() for field in text.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in ObservationColumns.COLUMNS]
+    if unknown:
+        raise ValueError("Unknown fields: {}, expected any of: {}".format(
+                ", ".join(unknown), ", ".join(ObservationColumns.COLUMNS)))
+    if not fields:
+        raise ValueError("No fields named, expected any of: {}".format(
+                ", ".join(ObservationColumns.COLUMNS)))
+
+    return fields
+
+
+def Project(observation, fields):
+    # Narrows an API observation dict to fields, the time is always kept
+    if fields is None:
+        return observation
+
+    return dict((key, value) for key, value in observation.items() if key in fields or key == "time")
+
+
+def ClampColumns(columns):
+    """
+        Applies the MIN_/MAX_ bounds to every value column of an
+        ObservationColumns batch in place, a whole column at a time. Uses
+        numpy.clip on a zero-copy view of each array when NumPy is
+        installed and a plain loop otherwise. Missing (NaN) values are
+        rejected and set to the lower bound, as a missing value compared
+        below every bound when observations were clamped one at a time.
+
+        Returns a dict of field name to {"clamped": n, "rejected": n}.
+    """
+    counts = dict()
+    for name, low, high in COLUMN_BOUNDS:
+        column = getattr(columns, name)
+        if numpy is not None:
+            clamped, rejected = _ClampNumpy(column, low, high)
+        else:
+            clamped, rejected = _ClampLoop(column, low, high)
+        counts[name] = {"clamped": clamped, "rejected": rejected}
+
+    return counts
+
+
+def _ClampNumpy(column, low, high):
+    values = numpy.frombuffer(column, dtype=numpy.float64)
+    missing = numpy.isnan(values)
+    rejected = int(missing.sum())
+    values[missing] = low
+
+    clamped = int(numpy.count_nonzero((values < low) | (values > high)))
+    numpy.clip(values, low, high, out=values)
+
+    return clamped, rejected
+
+
+def _ClampLoop(column, low, high):
+    clamped = rejected = 0
+    for i, value in enumerate(column):
+        if value != value:
+            column[i] = low
+            rejected += 1
+        elif value < low:
+            column[i] = low
+            clamped += 1
+        elif value > high:
+            column[i] = high
+            clamped += 1
+
+    return clamped, rejected
+
+
+def ValidateBatch(observations):
+    """
+        Validates a batch of observation dicts and clamps their values to
+        the observation bounds column by column with ClampColumns, rather
+        than field by field for every row. Observations without a numeric
+        timestamp between MIN_TIMESTAMP and MAX_TIMESTAMP, or with a value
+        that is not a number, are rejected whole. Fields that are left out
+        default to 0 before clamping.
+
+        Returns an ObservationColumns of the usable observations, a list of
+        {"index", "error"} for each rejected one and per-field clamped and
+        rejected counts.
+    """
+    counts = dict((name, {"clamped": 0, "rejected": 0}) for name in ObservationColumns.COLUMNS)
+    rows = list()
+    errors = list()
+
+    for index, obs in enumerate(observations):
+        if type(obs) != dict:
+            errors.append({"index": index, "error": "Unknown format"})
+            continue
+
+        lux = obs.get("lux", 0)
+        if type(lux) == dict:
+            lux = lux.get("luxd")
+
+        row = (obs.get("temp", 0), obs.get("pres", 0), obs.get("rhum", 0), lux,
+               obs.get("alt", 0), obs.get("time"))
+
+        invalid = [name for name, value in zip(ObservationColumns.COLUMNS, row)
+                   if type(value) not in NUMBER_TYPES]
+        if "time" not in invalid and not _ValidTimestamp(row[5]):
+            invalid.append("time")
+        if invalid:
+            for name in invalid:
+                counts[name]["rejected"] += 1
+            errors.append({"index": index, "error": ", ".join(
+                "Missing or invalid timestamp" if name == "time" else "Invalid value for " + name
+                for name in invalid)})
+            continue
+
+        rows.append(row[:5] + (int(row[5]),))
+
+    columns = ObservationColumns(rows)
+    for name, fieldCounts in ClampColumns(columns).items():
+        counts[name]["clamped"] += fieldCounts["clamped"]
+        counts[name]["rejected"] += fieldCounts["rejected"]
+
+    return columns, errors, counts
+
+
+def _ValidTimestamp(value):
+    # Finite and within the timestamp range, JSON numbers are neither
+    if value != value or value in (float("inf"), float("-inf")):
+        return False
+
+    return MIN_TIMESTAMP <= int(value) <= MAX_TIMESTAMP
@@ -1,9 +1,57 @@
 #!/usr/bin/env python
 
-from bottle import route, run, template, HTTPError, redirect, default_app, request
-from weather import WeatherHistory
+from bottle import route, run, template, HTTPError, HTTPResponse, redirect, default_app, request, response
+from bottle import http_date, parse_date
+from weather import WeatherHistory, CloseConnections
+from observation import InvalidObservationError, ObservationColumns, ParseFields
+from ingest import IngestQueue, QueueFullError, DURABILITY_MODES
+import downsample
+import export
+import live
+import metrics
+import signal
+import sys
+import tempfile
+import time
 import json
 
+# Observations returned per page by /api/observations
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
+# Points per series returned by /api/downsample
+DEFAULT_POINTS = 500
+MAX_POINTS = 5000
+
+# POSTed observations are queued and group committed by a writer thread,
+# clients choose with ?durability= whether to wait for the commit
+DEFAULT_DURABILITY = "enqueue"
+COMMIT_TIMEOUT = 10.0
+INGEST = IngestQueue()
+
+# Seconds an event stream is held before the client is left to reconnect,
+# each open stream holds a worker thread
+STREAM_TIMEOUT = 600
+
+# Longest wait of a /api/stream/poll request, in seconds
+POLL_TIMEOUT = 30
+
+def shutdown():
+    # Commit whatever is still queued before the connections go away
+    INGEST.Stop()
+    CloseConnections()
+
+def terminate(signum, frame):
+    shutdown()
+    sys.exit(0)
+
+try:
+    # uWSGI runs this when it shuts a worker down, SIGTERM included
+    import uwsgi
+    uwsgi.atexit = shutdown
+except ImportError:
+    signal.signal(signal.SIGTERM, terminate)
+
 
 @route("/")
 def index():
@@ -14,44 +62,337 @@ def api():
     return '''
         <html><body>
         <h3>Available API paths:</h3>
-        <p>GET /api/observation/&lt;type&gt; -  This returns a single datapoint for the most recent observation for any of these types values: temp, pres, rhum, lux, alt, time</p>
-        <p>GET /api/observations - Returns all observations as a json object
-        <p>GET /api/observations/&lt;timestamp&gt; - Returns all observations recorded since &lt;timestamp&gt;, which should be in unix time format.</p>
-        <p>POST /api/addobservation - Adds a new observation based on the form data posted. Requires at least the timestamp to be provided values used are:. temp, pres, rhum, lux, alt, time</p>
+        <p>GET /api/observation/&lt;type&gt; - Returns the most recent value of one of temp, pres, rhum, lux, alt or time, as {"&lt;type&gt;": value, "time": timestamp}. Only that column is read.</p>
+        <p>GET /api/observations - Returns a page of observations, newest first, as {"observations": [...], "next": cursor}. Optional query parameters: since and until (unix time, since is exclusive), limit (page size, default 500, at most 5000) and cursor (the next value from the previous page, null on the last page).</p>
+        <p>GET /api/observations/&lt;timestamp&gt; - Returns observations recorded since &lt;timestamp&gt;, which should be in unix time format. Paged as above.</p>
+        <p>GET /api/observations?export=json|ndjson - Streams every observation in the since/until range, unpaged, as a single JSON array or as one JSON object per line.</p>
+        <p>GET /api/rollup/&lt;resolution&gt; - Returns hourly or daily summaries, newest first, with the count and the min, max and mean of temp, pres, rhum, lux and alt for each hour or UTC day. Takes the same since, until, limit and cursor parameters as /api/observations.</p>
+        <p>GET /api/downsample - Returns a chart ready series of [time, value] points for each of temp, pres, rhum, lux and alt, reduced to about points points (default 500) over the since/until range. mode is lttb (Largest-Triangle-Three-Buckets, default) or minmax (lowest and highest point of each bucket).</p>
+        <p>GET /api/export - Downloads the observations in the since/until range in a columnar binary format: format=struct (default, packed little-endian columns that can be memory-mapped, see export.py) or format=parquet / format=arrow when pyarrow is installed.</p>
+        <p>GET /api/stream - Server-Sent Events stream of new observations, one observation event per reading with the observation as data and its timestamp as id. Starts with the latest observation, or with those after since (or Last-Event-ID when reconnecting).</p>
+        <p>GET /api/stream/poll - Long-poll fallback for /api/stream. Waits up to timeout seconds (default and at most 30) for observations after since and returns them oldest first as {"observations": [...], "next": since for the next poll}. Without since the latest observation is returned at once, if there is one.</p>
+        <p>POST /api/addobservation - Adds a new observation based on the form data posted. Requires at least the timestamp to be provided values used are:. temp, pres, rhum, lux, alt, time. Observations are queued and committed in groups; by default the reply (202) is sent once the observation is queued. With ?durability=commit the reply waits for the commit and is 409 for a duplicate or archived timestamp.</p>
+        <p>fields - GET /api/observations (paged or exported), /api/latest, /api/downsample, /api/stream and /api/stream/poll take fields, a comma separated list of temp, pres, rhum, lux, alt and time, and return only those fields, reading only their columns where the observations come from the database. time is always included and raw is left out, for example fields=temp.</p>
+        <p>GET /api/metrics - Request, SQL and cache metrics of the answering process in the Prometheus text format. When the WEATHER_PROFILE_DIR environment variable names a directory, a request sent with X-Profile: 1 or ?profile=1 is profiled and the file the stats were written to is named in its X-Profile-Dump header.</p>
+        <p>POST /api/observations/batch - Adds many observations in one transaction, posted as a JSON array or as NDJSON (Content-Type: application/x-ndjson). Returns counts of accepted, duplicate, rejected and archived observations; observations in archived months are not stored.</p>
         </body></html>
     '''
 
-@route("/api/observation/<type>")
-def observation(_type):
-    types = ["TEMP", "PRES", "RHUM", "LUX", "ALT", "TIME"]
+@route("/api/observation/<obstype>")
+def observation(obstype):
+    if obstype.lower() not in ObservationColumns.COLUMNS:
+        raise HTTPError(404, "Invalid observation type: {}".format(obstype))
+    fields = [obstype.lower()]
 
-    if( _type.upper() not in types ):
-        raise HTTPError(404, "Invalid observation type: {}".format(_type)) 
-    
-    return '{"{}":{}'.format(_type, )
+    wh = WeatherHistory(None)
+    checkModified(wh)
+    latest = wh.LatestObservation(fields)
+    if latest is None:
+        raise HTTPError(404, "No observations recorded yet")
+
+    return json.dumps(latest)
 
 @route("/api/observations")
 def observations():
+    return observationPage(intParam("since"))
+
+@route("/api/observations/<timestamp:int>")
+def observationsSince(timestamp):
+    return observationPage(timestamp)
+
+def observationPage(since):
+    wh = WeatherHistory(None)
+    checkModified(wh)
+
+    fields = fieldsParam()
+    export = request.query.get("export")
+    if export:
+        return observationExport(wh, since, export, fields)
+
+    observations, cursor = wh.LoadObservationPage(since, intParam("until"), limitParam(),
+            intParam("cursor"), fields)
+
+    return json.dumps({
+        "observations": list(observations.toDicts(fields)),
+        "next": None if cursor is None else str(cursor)
+    })
+
+def observationExport(wh, since, export, fields):
+    # Streams the whole range instead of a page, one chunk per batch of rows
+    if export not in ("json", "ndjson"):
+        raise HTTPError(400, "export must be json or ndjson")
+
+    batches = wh.IterObservations(since, intParam("until"), _fields=fields)
+
+    if export == "ndjson":
+        response.content_type = "application/x-ndjson"
+        return ("".join(json.dumps(obs) + "\n" for obs in batch.toDicts(fields)) for batch in batches)
+
+    response.content_type = "application/json"
+    return jsonArrayChunks(batches, fields)
+
+def jsonArrayChunks(batches, fields):
+    yield "["
+    separator = ""
+    for batch in batches:
+        yield separator + ",".join(json.dumps(obs) for obs in batch.toDicts(fields))
+        separator = ","
+    yield "]"
+
+def checkModified(wh):
+    """
+        Sets ETag and Last-Modified from the newest stored observation and
+        the database's write counter and answers 304 Not Modified, before
+        any rows are read, when the client's copy is still current. The
+        counter catches older observations stored after newer ones.
+    """
+    validator = wh.Validator()
+    if validator is None:
+        return
+
+    newest, writes, modified = validator
+    modified = max(newest, modified)
+    headers = {
+        "ETag": '"{}-{}"'.format(newest, writes),
+        "Last-Modified": http_date(modified),
+        "Cache-Control": "no-cache"
+    }
+    for name, value in headers.items():
+        response.set_header(name, value)
+
+    match = request.headers.get("If-None-Match")
+    if match is not None:
+        notModified = match.strip() == "*" or headers["ETag"] in [tag.strip() for tag in match.split(",")]
+    else:
+        since = parse_date(request.headers.get("If-Modified-Since", "").split(";")[0].strip())
+        notModified = since is not None and since >= modified
+
+    metrics.Cache("http", notModified)
+    if notModified:
+        raise HTTPResponse(status=304, headers=headers)
+
+def limitParam():
+    limit = intParam("limit", DEFAULT_PAGE_SIZE)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise HTTPError(400, "limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    return limit
+
+def fieldsParam():
+    # Observation fields named by ?fields=, None for all of them
+    try:
+        return ParseFields(request.query.get("fields"))
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+def intParam(name, default=None):
+    # Integer query string parameter, or default when it is not given
+    value = request.query.get(name)
+    if value is None or value == "":
+        return default
+
+    try:
+        return timestampInt(value)
+    except ValueError:
+        raise HTTPError(400, "{} must be an integer timestamp".format(name))
+
+def timestampInt(value):
+    # Larger values would not fit the timestamp columns or the query
+    value = int(value)
+    if value < WeatherHistory.MIN_TIMESTAMP or value > WeatherHistory.MAX_TIMESTAMP:
+        raise ValueError("{} is out of range".format(value))
+
+    return value
+
+@route("/api/rollup/<resolution>")
+def rollup(resolution):
+    if resolution not in WeatherHistory.ROLLUP_RESOLUTIONS:
+        raise HTTPError(404, "Invalid rollup resolution: {}".format(resolution))
+
     wh = WeatherHistory(None)
-    observations = wh.LoadObservations()
+    checkModified(wh)
+    rollups, cursor = wh.LoadRollupPage(resolution, intParam("since"), intParam("until"),
+            limitParam(), intParam("cursor"))
 
-    return json.dumps(observations)
+    return json.dumps({
+        "rollups": rollups,
+        "next": None if cursor is None else str(cursor)
+    })
 
-@route("/api/observations/<timestamp>")
-def observations(timestamp):
-    pass
+@route("/api/downsample")
+def downsampled():
+    points = intParam("points", DEFAULT_POINTS)
+    if points < 3 or points > MAX_POINTS:
+        raise HTTPError(400, "points must be between 3 and {}".format(MAX_POINTS))
+
+    mode = request.query.get("mode", "lttb")
+    if mode not in downsample.MODES:
+        raise HTTPError(400, "mode must be one of: {}".format(", ".join(downsample.MODES)))
+
+    wh = WeatherHistory(None)
+    checkModified(wh)
+    series = wh.DownsampleObservations(intParam("since"), intParam("until"), points, mode,
+            fieldsParam())
+
+    return json.dumps({"mode": mode, "series": series})
+
+@route("/api/export")
+def exportObservations():
+    fmt = request.query.get("format", "struct")
+    if not export.Available(fmt):
+        raise HTTPError(400, "Unsupported export format: {}".format(fmt))
+
+    wh = WeatherHistory(None)
+    checkModified(wh)
+
+    # Written to a temporary file first, then streamed back from it
+    out = tempfile.TemporaryFile()
+    export.Export(wh, out, fmt, intParam("since"), intParam("until"))
+    out.seek(0)
+
+    response.content_type = export.CONTENT_TYPES[fmt]
+    response.set_header("Content-Disposition",
+            "attachment; filename=weather.{}".format(export.EXTENSIONS[fmt]))
+    return out
 
 @route("/api/latest")
 def latest():
     wh = WeatherHistory(None)
-    latest = wh.LatestObservation()
+    checkModified(wh)
+    latest = wh.LatestObservation(fieldsParam())
+    if latest is None:
+        raise HTTPError(404, "No observations recorded yet")
+
     return json.dumps(latest)
 
+@route("/api/stream")
+def stream():
+    wh = WeatherHistory(None)
+    since = streamSince()
+    fields = fieldsParam()
+
+    response.content_type = "text/event-stream"
+    response.set_header("Cache-Control", "no-cache")
+    # Stop nginx from buffering the stream
+    response.set_header("X-Accel-Buffering", "no")
+    return eventStream(wh, since, fields)
+
+def eventStream(wh, since, fields=None):
+    yield "retry: {}\n\n".format(live.RETRY)
+
+    deadline = time.time() + STREAM_TIMEOUT
+    observations = live.Replay(wh, since, fields)
+    if since is None:
+        since = wh.MIN_TIMESTAMP
+
+    while True:
+        if observations:
+            since = observations[-1]["time"]
+            yield "".join(live.Event(obs) for obs in observations)
+        else:
+            yield live.Heartbeat()
+
+        if time.time() >= deadline:
+            return
+        observations = live.Wait(wh, since, live.HEARTBEAT, fields)
+
+@route("/api/stream/poll")
+def streamPoll():
+    wh = WeatherHistory(None)
+    since = streamSince()
+    fields = fieldsParam()
+    timeout = intParam("timeout", POLL_TIMEOUT)
+    if timeout < 0 or timeout > POLL_TIMEOUT:
+        raise HTTPError(400, "timeout must be between 0 and {}".format(POLL_TIMEOUT))
+
+    observations = live.Replay(wh, since, fields)
+    if not observations:
+        observations = live.Wait(wh, wh.MIN_TIMESTAMP if since is None else since, timeout, fields)
+
+    if observations:
+        since = observations[-1]["time"]
+
+    response.set_header("Cache-Control", "no-cache")
+    return json.dumps({
+        "observations": observations,
+        "next": None if since is None else str(since)
+    })
+
+def streamSince():
+    # A reconnecting EventSource sends the id of the last event it received
+    lastId = request.get_header("Last-Event-ID")
+    if lastId:
+        try:
+            return timestampInt(lastId)
+        except ValueError:
+            raise HTTPError(400, "Last-Event-ID must be an integer timestamp")
+
+    return intParam("since")
+
 @route("/api/addobservation", method='POST')
 def addObservation():
-    wh = WeatherHistory(None)
+    durability = request.query.get("durability", DEFAULT_DURABILITY)
+    if durability not in DURABILITY_MODES:
+        raise HTTPError(400, "durability must be one of: {}".format(", ".join(DURABILITY_MODES)))
+
+    try:
+        ticket = INGEST.Put(request.json, durability)
+    except InvalidObservationError as e:
+        raise HTTPError(400, "Invalid observation: {}".format(e))
+    except QueueFullError as e:
+        raise HTTPError(503, "Observation not queued: {}".format(e), headers={"Retry-After": "1"})
+
+    result = ticket.Wait(COMMIT_TIMEOUT) if ticket else None
+    if result == "duplicate":
+        raise HTTPError(409, "Observation already recorded for this timestamp")
+    if result == "archived":
+        raise HTTPError(409, "Observation falls in an archived month")
+    if result == "failed":
+        raise HTTPError(503, "Observation could not be stored")
+    if result is None:
+        # Queued, the commit has not happened yet
+        response.status = 202
+        return "Observation queued"
 
-    wh.AddObservation(request.json)
     return "Post successfull"
 
-app = application = default_app()
+@route("/api/observations/batch", method='POST')
+def addObservations():
+    # Accepts either a JSON array of observations or NDJSON, one
+    # observation per line
+    try:
+        if request.content_type.startswith("application/x-ndjson"):
+            batch = [json.loads(line) for line in request.body if line.strip()]
+        else:
+            batch = json.load(request.body)
+    except ValueError as e:
+        raise HTTPError(400, "Invalid JSON: {}".format(e))
+
+    if type(batch) != list:
+        raise HTTPError(400, "Expected a JSON array of observations")
+
+    wh = WeatherHistory(None)
+    return json.dumps(wh.AddObservations(batch))
+
+@route("/api/metrics")
+def metricsText():
+    response.content_type = "text/plain; version=0.0.4"
+    return metrics.REGISTRY.Render()
+
+def ingestLag():
+    newest = WeatherHistory(None).NewestTimestamp()
+    return [((), time.time() - newest)] if newest is not None else []
+
+def ingestQueue():
+    stats = INGEST.Stats()
+    return [((("state", name),), stats[name]) for name in ("pending", "committed", "dropped")]
+
+metrics.REGISTRY.Gauge("weather_ingest_lag_seconds",
+        "Seconds since the newest stored observation was recorded.", ingestLag)
+metrics.REGISTRY.Gauge("weather_ingest_queue_observations",
+        "Observations queued for the writer and committed or dropped by it.", ingestQueue)
+metrics.REGISTRY.Gauge("weather_ingest_commit_lag_seconds",
+        "Seconds the oldest observation of the last committed group waited in the queue.",
+        lambda: [((), INGEST.Stats()["lag"])])
+
+app = application = metrics.Instrument(default_app())
@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 from datetime import datetime as dt
+import atexit
+import calendar
 import os
 import sqlite3
+import threading
+import time
 
-from observation import WeatherObservation
+from observation import InvalidObservationError, ObservationColumns, ObservationRecord, Project
+from observation import ValidateBatch, MIN_TIMESTAMP, MAX_TIMESTAMP
+from observation import (MIN_TEMPERATURE, MAX_TEMPERATURE, MIN_PRESSURE, MAX_PRESSURE,
+                         MIN_HUMIDITY, MAX_HUMIDITY, MIN_LUX, MAX_LUX, MIN_ALTITUDE, MAX_ALTITUDE)
+import downsample
+import live
+import metrics
 
 """
     Database table structure:
@@ -14,9 +26,168 @@ from observation import WeatherObservation
         int relative_humidity,
         real lux,
         int altitude,
-        int timestamp,
+        int timestamp, primary key
+
+    table partitions:
+        int month, primary key, YYYYMM of an archived UTC month
+        text path, archive file name, relative to the database file
+        int first, int last, timestamp range of the month
+        int count, observations moved to the archive
+
+    tables rollup_hourly, rollup_daily:
+        int bucket, primary key, start of the UTC hour or day
+        int count,
+        real <type>_min, <type>_max, <type>_sum for each of
+            temp, pres, rhum, lux, alt
+
+    table writes:
+        int id, primary key, the single row 0
+        int count, commits that changed the stored observations or rollups
+        int modified, unix time of the last of them
+
+    The schema version is kept in PRAGMA user_version and existing
+    databases are upgraded in place by WeatherHistory.MIGRATIONS. From
+    version 4 every stored row has been clamped to the observation bounds
+    when it was written, so rows are read back as they are stored without
+    validating them again.
+
+    Cold months can be moved out of the observations table with
+    WeatherHistory.ArchiveMonth into one read-only database file per month,
+    kept next to the main one. Range queries only attach and read the
+    archives whose month overlaps the range.
 """
 
+class WeatherDBError(Exception):
+    """
+        Raised when a query against the weather database fails.
+    """
+
+
+class DuplicateObservationError(WeatherDBError):
+    """
+        Raised when an observation with the same timestamp is already stored.
+    """
+
+
+class ArchivedObservationError(WeatherDBError):
+    """
+        Raised when an observation falls in a month that has been archived.
+    """
+
+
+class ConnectionPool:
+    """
+        Hands out one sqlite connection per database file per thread.
+        Connections are opened lazily on first use so that uWSGI can fork
+        its workers before any database handle exists, are configured once
+        when opened and are closed when their thread has exited, or at
+        shutdown.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL;",
+        "PRAGMA synchronous=NORMAL;",
+        "PRAGMA mmap_size=67108864;",
+        "PRAGMA cache_size=-8000;",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns = list()
+        self._pid = os.getpid()
+
+    def Get(self, _dbfile, _setup=None):
+        """
+            Returns the calling thread's connection to _dbfile, opening it
+            and running _setup(conn) if this thread has not used it before.
+        """
+        if self._pid != os.getpid():
+            self._AfterFork()
+
+        conns = self._Local("conns")
+
+        conn = conns.get(_dbfile)
+        if conn is None:
+            # check_same_thread is disabled only so that CloseAll can run
+            # from the shutdown hook, each connection stays with one thread
+            conn = sqlite3.connect(_dbfile, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            if _setup:
+                _setup(conn)
+
+            conns[_dbfile] = conn
+            with self._lock:
+                self._conns.append((threading.current_thread(), conn))
+            self._Prune()
+
+        return conn
+
+    def _Prune(self):
+        # Closes the connections of threads that have exited, servers that
+        # start a thread per request would otherwise keep one open for each
+        with self._lock:
+            dead = [conn for thread, conn in self._conns if not thread.is_alive()]
+            self._conns = [(thread, conn) for thread, conn in self._conns if thread.is_alive()]
+
+        for conn in dead:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def State(self, _dbfile):
+        """
+            Returns a dict private to the calling thread's connection to
+            _dbfile, for caches that are only valid for that connection.
+        """
+        if self._pid != os.getpid():
+            self._AfterFork()
+
+        return self._Local("state").setdefault(_dbfile, dict())
+
+    def _Local(self, name):
+        value = getattr(self._local, name, None)
+        if value is None:
+            value = dict()
+            setattr(self._local, name, value)
+
+        return value
+
+    def CloseAll(self):
+        with self._lock:
+            conns, self._conns = self._conns, list()
+        self._local = threading.local()
+
+        for thread, conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def _AfterFork(self):
+        # Handles inherited from the parent must not be used or closed in
+        # the child, keep them referenced and start again with a clean pool
+        self._orphans = self._conns
+        self._conns = list()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+
+POOL = ConnectionPool()
+atexit.register(POOL.CloseAll)
+
+
+def CloseConnections():
+    """
+        Closes every pooled database connection, used as the uWSGI and
+        interpreter shutdown hook.
+    """
+    POOL.CloseAll()
+
+
 class WeatherHistory:
     """
         Represents all historical data stored in the database,
@@ -27,14 +198,146 @@ class WeatherHistory:
 
     DBFILE = "/var/www/weather/Weather.db"
 
-    # SQL statements
-    CREATE_TABLE_OBSERVATIONS = '''CREATE TABLE observations
+    # Timestamp bounds used when a range query leaves one end open
+    MIN_TIMESTAMP = MIN_TIMESTAMP
+    MAX_TIMESTAMP = MAX_TIMESTAMP
+
+    # Archive files are opened on demand, at most this many at once
+    ARCHIVE_ATTACH_LIMIT = 4
+    ARCHIVE_FILE = "Weather-{:04d}-{:02d}.db"
+
+    # Observations table column of each API field, in table order
+    FIELD_COLUMNS = (("temp", "temperature"), ("pres", "preasure"), ("rhum", "relative_humiditiy"),
+                     ("lux", "lux"), ("alt", "altitude"), ("time", "timestamp"))
+
+    # SQL statements, {0} in the observation range queries is the table to
+    # read, observations or an attached archive's <schema>.observations, and
+    # {1} the columns read, see _Projection
+    CREATE_TABLE_OBSERVATIONS = '''CREATE TABLE IF NOT EXISTS observations
                 (temperature real, preasure real, relative_humiditiy integer, lux real,
                  altitude integer, timestamp integer)'''
-    SELECT_ALL = "SELECT * FROM observations ORDER BY timestamp DESC;"
-    SELECT_LATEST = "SELECT * FROM observations ORDER BY timestamp DESC LIMIT 1;"
-    SELECT_TIMESTAMP = "SELECT * FROM observations WHERE timestamp > {} ORDER BY timestamp DESC;"
-    INSERT_OBSERVATION = "INSERT INTO observations VALUES({}, {}, {}, {}, {}, {});"
+    SELECT_LATEST = "SELECT {1} FROM {0} ORDER BY timestamp DESC LIMIT 1;"
+    SELECT_NEWEST = "SELECT MAX(timestamp) FROM {0};"
+    DATA_VERSION = "PRAGMA data_version;"
+    SELECT_RANGE = '''SELECT {1} FROM {0} WHERE timestamp > ? AND timestamp <= ?
+                ORDER BY timestamp DESC LIMIT ?;'''
+    SELECT_RANGE_ASC = '''SELECT {1} FROM {0} WHERE timestamp > ? AND timestamp <= ?
+                ORDER BY timestamp LIMIT ?;'''
+    SELECT_RANGE_BOUNDS = '''SELECT MIN(timestamp), MAX(timestamp) FROM {0}
+                WHERE timestamp > ? AND timestamp <= ?;'''
+    SELECT_SERIES = '''SELECT {1} FROM {0} WHERE timestamp > ? AND timestamp <= ?
+                ORDER BY timestamp;'''
+    INSERT_OBSERVATION = "INSERT INTO observations VALUES(?, ?, ?, ?, ?, ?);"
+    INSERT_OBSERVATION_BATCH = "INSERT OR IGNORE INTO observations VALUES(?, ?, ?, ?, ?, ?);"
+
+    # Rollup resolutions and the width of their buckets in seconds
+    ROLLUP_RESOLUTIONS = {"hourly": 3600, "daily": 86400}
+    ROLLUP_TYPES = ("temp", "pres", "rhum", "lux", "alt")
+
+    # Rollup SQL templates, formatted with the resolution and bucket width.
+    # The formatted text is the same on every call so the statements are
+    # still served from the statement cache.
+    CREATE_TABLE_ROLLUP = '''CREATE TABLE IF NOT EXISTS rollup_{0}
+                (bucket integer PRIMARY KEY, count integer,
+                 temp_min real, temp_max real, temp_sum real,
+                 pres_min real, pres_max real, pres_sum real,
+                 rhum_min real, rhum_max real, rhum_sum real,
+                 lux_min real, lux_max real, lux_sum real,
+                 alt_min real, alt_max real, alt_sum real)'''
+    BUILD_ROLLUP = '''INSERT OR REPLACE INTO rollup_{0}
+                SELECT timestamp - timestamp % {1} AS bucket, COUNT(*),
+                       MIN(temperature), MAX(temperature), SUM(temperature),
+                       MIN(preasure), MAX(preasure), SUM(preasure),
+                       MIN(relative_humiditiy), MAX(relative_humiditiy), SUM(relative_humiditiy),
+                       MIN(lux), MAX(lux), SUM(lux),
+                       MIN(altitude), MAX(altitude), SUM(altitude)
+                FROM observations GROUP BY bucket'''
+    DELETE_ROLLUP = "DELETE FROM rollup_{0} WHERE bucket > ?"
+    INSERT_ROLLUP = "INSERT OR IGNORE INTO rollup_{0} VALUES(?, 0, ?, ?, 0, ?, ?, 0, ?, ?, 0, ?, ?, 0, ?, ?, 0)"
+    UPDATE_ROLLUP = '''UPDATE rollup_{0} SET count = count + 1,
+                temp_min = MIN(temp_min, ?), temp_max = MAX(temp_max, ?), temp_sum = temp_sum + ?,
+                pres_min = MIN(pres_min, ?), pres_max = MAX(pres_max, ?), pres_sum = pres_sum + ?,
+                rhum_min = MIN(rhum_min, ?), rhum_max = MAX(rhum_max, ?), rhum_sum = rhum_sum + ?,
+                lux_min = MIN(lux_min, ?), lux_max = MAX(lux_max, ?), lux_sum = lux_sum + ?,
+                alt_min = MIN(alt_min, ?), alt_max = MAX(alt_max, ?), alt_sum = alt_sum + ?
+                WHERE bucket = ?'''
+    SELECT_ROLLUP_RANGE = '''SELECT * FROM rollup_{0} WHERE bucket > ? AND bucket <= ?
+                ORDER BY bucket DESC LIMIT ?;'''
+
+    # Archived months
+    CREATE_TABLE_PARTITIONS = '''CREATE TABLE IF NOT EXISTS partitions
+                (month integer PRIMARY KEY, path text, first integer, last integer,
+                 count integer)'''
+    CREATE_TABLE_ARCHIVE = '''CREATE TABLE IF NOT EXISTS {0}.observations
+                (temperature real, preasure real, relative_humiditiy integer, lux real,
+                 altitude integer, timestamp integer PRIMARY KEY)'''
+    SELECT_PARTITIONS = '''SELECT month, path FROM partitions WHERE last > ? AND first <= ?
+                ORDER BY month DESC;'''
+    SELECT_PARTITION = "SELECT month FROM partitions WHERE month = ?;"
+    SELECT_ARCHIVED_UNTIL = "SELECT MAX(last) FROM partitions;"
+    SELECT_OLDEST = "SELECT MIN(timestamp) FROM observations;"
+    COPY_TO_ARCHIVE = '''INSERT OR IGNORE INTO {0}.observations
+                SELECT * FROM observations WHERE timestamp >= ? AND timestamp <= ?'''
+    COUNT_ARCHIVE = "SELECT COUNT(*) FROM {0}.observations"
+    DELETE_ARCHIVED = "DELETE FROM observations WHERE timestamp >= ? AND timestamp <= ?"
+    INSERT_PARTITION = "INSERT INTO partitions VALUES(?, ?, ?, ?, ?)"
+    ATTACH_ARCHIVE = "ATTACH DATABASE ? AS {0};"
+    DETACH_ARCHIVE = "DETACH DATABASE {0};"
+
+    # Counter bumped, with the time, by every commit that changes what the
+    # read endpoints return, for the HTTP validators. Stored observations
+    # are not always newer than the newest one.
+    CREATE_TABLE_WRITES = '''CREATE TABLE IF NOT EXISTS writes
+                (id integer PRIMARY KEY, count integer, modified integer)'''
+    BUMP_WRITES = '''UPDATE writes SET count = count + 1,
+                modified = CAST(strftime('%s', 'now') AS integer) WHERE id = 0'''
+    SELECT_WRITES = "SELECT count, modified FROM writes WHERE id = 0;"
+
+    # Clamps every stored value to the observation bounds, missing values
+    # become the lower bound as they did when rows were clamped on read
+    CLAMP_OBSERVATIONS = '''UPDATE observations SET
+                temperature = MIN(MAX(COALESCE(temperature, {0}), {0}), {1}),
+                preasure = MIN(MAX(COALESCE(preasure, {2}), {2}), {3}),
+                relative_humiditiy = MIN(MAX(COALESCE(relative_humiditiy, {4}), {4}), {5}),
+                lux = MIN(MAX(COALESCE(lux, {6}), {6}), {7}),
+                altitude = MIN(MAX(COALESCE(altitude, {8}), {8}), {9})'''.format(
+                MIN_TEMPERATURE, MAX_TEMPERATURE, MIN_PRESSURE, MAX_PRESSURE,
+                MIN_HUMIDITY, MAX_HUMIDITY, MIN_LUX, MAX_LUX, MIN_ALTITUDE, MAX_ALTITUDE)
+
+    # Schema migrations, MIGRATIONS[n] upgrades a database at user_version n
+    # to n + 1. Only ever append to this list, databases in the field are
+    # upgraded in place the first time a connection to them is opened.
+    MIGRATIONS = (
+        # 1: Original heap table, already present in unversioned databases
+        (CREATE_TABLE_OBSERVATIONS,),
+        # 2: Timestamp becomes the primary key, duplicate timestamps are
+        #    dropped keeping the first stored row
+        ('''CREATE TABLE observations_v2
+                (temperature real, preasure real, relative_humiditiy integer, lux real,
+                 altitude integer, timestamp integer PRIMARY KEY)''',
+         '''INSERT OR IGNORE INTO observations_v2
+                SELECT temperature, preasure, relative_humiditiy, lux, altitude,
+                       CAST(timestamp AS integer)
+                FROM observations WHERE timestamp IS NOT NULL ORDER BY rowid''',
+         "DROP TABLE observations",
+         "ALTER TABLE observations_v2 RENAME TO observations"),
+        # 3: Hourly and daily rollup tables, backfilled from observations
+        (CREATE_TABLE_ROLLUP.format("hourly"),
+         CREATE_TABLE_ROLLUP.format("daily"),
+         BUILD_ROLLUP.format("hourly", 3600),
+         BUILD_ROLLUP.format("daily", 86400)),
+        # 4: Rows written before observations were clamped on write are
+        #    clamped once here, the rollups are rebuilt from the new values
+        (CLAMP_OBSERVATIONS,
+         BUILD_ROLLUP.format("hourly", 3600),
+         BUILD_ROLLUP.format("daily", 86400)),
+        # 5: Register of months archived to their own database files
+        (CREATE_TABLE_PARTITIONS,),
+        # 6: Write counter for the HTTP validators
+        (CREATE_TABLE_WRITES,
+         "INSERT INTO writes VALUES(0, 0, 0)"),
+    )
+    SCHEMA_VERSION = len(MIGRATIONS)
 
     def __init__(self, _dbfile):
         if( _dbfile ):
@@ -44,70 +347,571 @@ class WeatherHistory:
         
         # Init our DB
         self.conn, self.cur = self._CreateDB(self.dbfile)
+        self.state = POOL.State(self.dbfile)
 
-    def _WriteDB(self, sql):
-        print sql
-        if sqlite3.complete_statement(sql):
-            try:
-                self.cur.execute(sql)
-                self.conn.commit()
-                print "Writen to db and commited"
-            except sqlite3.Error as e:
-               return e.args[0]
-            
-            return True
-        else:
-            return "Invalid SQL" 
+    # SQL is only ever one of the constant statements above with values
+    # bound as parameters, so the text stays identical between calls and
+    # the connection's statement cache skips re-parsing and planning it.
+    #
+    # Statements in then are (sql, rows) pairs run with executemany in the
+    # same transaction, after sql and before the commit. name is the name
+    # of the constant sql was made from, the statement label of its metrics.
+    def _WriteDB(self, name, sql, params=(), then=()):
+        # Returns the number of rows changed by sql
+        start = time.time()
+        try:
+            self.cur.execute(sql, params)
+            rowcount = self.cur.rowcount
+            for thenSql, rows in then:
+                self.cur.executemany(thenSql, rows)
+            self.conn.commit()
+        except sqlite3.IntegrityError as e:
+            self.conn.rollback()
+            raise DuplicateObservationError(e.args[0])
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            raise WeatherDBError(e.args[0])
 
-    def _ReadDB(self, sql):
-        if not sql.upper().startswith("SELECT"):
-            return "Not a SELECT statement" 
-        if sqlite3.complete_statement(sql):
-            try:
-                self.cur.execute(sql)
-                
-                return self.cur.fetchall()
-            except sqlite3.Error as e:
-                return e.args[0]
-        else:
-            return "Invalid SQL" 
+        metrics.SQL(name, time.time() - start, written=rowcount)
+        return rowcount
+
+    def _ReadDB(self, name, sql, params=()):
+        # Returns a list of row tuples
+        start = time.time()
+        try:
+            self.cur.execute(sql, params)
+            rows = self.cur.fetchall()
+        except sqlite3.Error as e:
+            raise WeatherDBError(e.args[0])
+
+        metrics.SQL(name, time.time() - start, read=len(rows))
+        return rows
 
     def _CreateDB(self, _dbfile):
-        if( os.path.isfile(_dbfile) ):
-            conn = sqlite3.connect(_dbfile)
-            c = conn.cursor()
-            return conn, c
-        else:
-            # Create database and initialise the tables
-            conn = sqlite3.connect(_dbfile)
-            c = conn.cursor()
+        # Reuse this thread's pooled connection, the tables are only
+        # initialised the first time the connection is opened
+        conn = POOL.Get(_dbfile, self._MigrateDB)
+        return conn, conn.cursor()
 
-            c.execute(self.CREATE_TABLE_OBSERVATIONS)
-            conn.commit()
+    def _MigrateDB(self, conn):
+        # Create the database or bring it up to SCHEMA_VERSION
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
 
-            return conn, c
+        # The sqlite3 module commits before DDL statements on its own, take
+        # manual control of the transaction so each upgrade is atomic
+        isolation, conn.isolation_level = conn.isolation_level, None
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                # Another worker may have upgraded while we waited for the lock
+                version = conn.execute("PRAGMA user_version;").fetchone()[0]
+                for target in range(version, self.SCHEMA_VERSION):
+                    for sql in self.MIGRATIONS[target]:
+                        conn.execute(sql)
+                    conn.execute("PRAGMA user_version = {:d};".format(target + 1))
+                    print("WeatherHistory: schema upgraded to version {}".format(target + 1))
+                conn.execute("COMMIT;")
+            except:
+                conn.execute("ROLLBACK;")
+                raise
+        finally:
+            conn.isolation_level = isolation
 
     def LoadObservations(self):
         # Read historical observations from database
-        history = self._ReadDB(self.SELECT_ALL)
-        
-        print "WeatherHistory: {} records loaded.".format(len(history))
         observations = list()
-        for obs in history:
-            observations.append(WeatherObservation(obs).getObservation())
+        for batch in self.IterObservations():
+            observations.extend(batch.toDicts())
 
+        print("WeatherHistory: {} records loaded.".format(len(observations)))
         return observations
 
+    def LoadObservationPage(self, _since=None, _until=None, _limit=500, _cursor=None, _fields=None):
+        """
+            Returns up to _limit observations, newest first, recorded after
+            _since and up to and including _until, as ObservationColumns,
+            and the cursor for the next page or None if this is the last
+            one. Pages are keyed on the timestamp so each one is a primary
+            key range scan of the tables that overlap the page. Only the
+            columns of _fields are read when it is given.
+        """
+        since, until = self._Range(_since, _until, _cursor)
+        columns = self._Projection(_fields)
+        sqls = (self.SELECT_RANGE.format(table, columns) for table in self._Sources(since, until))
+        history, cursor = self._ReadPage("SELECT_RANGE", sqls, 5, since, until, _limit)
+
+        return ObservationColumns(history), cursor
+
+    def LoadRollupPage(self, _resolution, _since=None, _until=None, _limit=500, _cursor=None):
+        """
+            Returns a page of _resolution ("hourly" or "daily") rollups
+            newest first with the min, max and mean of each observation
+            type, paged the same way as LoadObservationPage.
+        """
+        if _resolution not in self.ROLLUP_RESOLUTIONS:
+            raise ValueError("Unknown rollup resolution: {}".format(_resolution))
+
+        since, until = self._Range(_since, _until, _cursor)
+        rows, cursor = self._ReadPage("SELECT_ROLLUP_RANGE",
+                [self.SELECT_ROLLUP_RANGE.format(_resolution)], 0, since, until, _limit)
+
+        rollups = list()
+        for row in rows:
+            rollup = {"time": row[0], "count": row[1]}
+            for i, key in enumerate(self.ROLLUP_TYPES):
+                low, high, total = row[2 + i * 3:5 + i * 3]
+                mean = total / float(row[1]) if row[1] and total is not None else None
+                rollup[key] = {"min": low, "max": high, "mean": mean}
+            rollups.append(rollup)
+
+        return rollups, cursor
+
+    def RebuildRollups(self):
+        # Recomputes the rollup tables from the stored observations in a
+        # single transaction. Archived months are read-only, their rollups
+        # are kept as they were when the month was archived.
+        archivedUntil = self._ArchivedUntil()
+        try:
+            for resolution, width in self.ROLLUP_RESOLUTIONS.items():
+                self.cur.execute(self.DELETE_ROLLUP.format(resolution), (archivedUntil,))
+                self.cur.execute(self.BUILD_ROLLUP.format(resolution, width))
+            self.cur.execute(self.BUMP_WRITES)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            raise WeatherDBError(e.args[0])
+
+    @classmethod
+    def _Projection(cls, _fields=None):
+        # Columns of the observation queries. Fields left out of _fields are
+        # read as NULL so rows keep the table's shape, the timestamp is
+        # always read.
+        if _fields is not None:
+            unknown = set(_fields) - set(field for field, column in cls.FIELD_COLUMNS)
+            if unknown:
+                raise ValueError("Unknown observation fields: {}".format(", ".join(sorted(unknown))))
+
+        return ", ".join(column if _fields is None or field in _fields or field == "time" else "NULL"
+                         for field, column in cls.FIELD_COLUMNS)
+
+    def _Range(self, _since, _until, _cursor=None):
+        # Exclusive lower and inclusive upper timestamp of a range query
+        since = self.MIN_TIMESTAMP if _since is None else _since
+        until = self.MAX_TIMESTAMP if _until is None else _until
+        if _cursor is not None:
+            until = min(until, max(_cursor - 1, self.MIN_TIMESTAMP))
+
+        return since, until
+
+    def _ReadPage(self, name, sqls, keyIndex, since, until, _limit):
+        # Runs a keyset paged range query over each of sqls in turn, newest
+        # first, until the page is full. Each sql takes the exclusive lower
+        # and inclusive upper key and the row limit. Returns the rows and
+        # the cursor for the next page, None on the last page.
+        rows = list()
+        for sql in sqls:
+            # Read one extra row to find out whether another page follows
+            rows += self._ReadDB(name, sql, (since, until, _limit + 1 - len(rows)))
+            if len(rows) > _limit:
+                break
+
+        cursor = None
+        if len(rows) > _limit:
+            rows = rows[:_limit]
+            cursor = rows[-1][keyIndex]
+
+        return rows, cursor
+
+    def IterObservations(self, _since=None, _until=None, _batch=500, _ascending=False, _fields=None):
+        """
+            Yields every observation recorded after _since and up to and
+            including _until, newest first unless _ascending, as
+            ObservationColumns batches of at most _batch, reading only the
+            columns of _fields when it is given.
+            Rows are pulled from the cursor with fetchmany so memory use
+            does not depend on the size of the table.
+        """
+        since, until = self._Range(_since, _until)
+        name = "SELECT_RANGE_ASC" if _ascending else "SELECT_RANGE"
+        sql = getattr(self, name)
+        columns = self._Projection(_fields)
+
+        # Use a cursor of our own, the shared one may be reused while the
+        # caller is still consuming this generator. A negative LIMIT is no
+        # limit in sqlite.
+        for table in self._Sources(since, until, _ascending):
+            cur = self.conn.cursor()
+            elapsed = 0.0
+            read = 0
+            try:
+                start = time.time()
+                cur.execute(sql.format(table, columns), (since, until, -1))
+                while True:
+                    history = cur.fetchmany(_batch)
+                    elapsed += time.time() - start
+                    if not history:
+                        break
+
+                    read += len(history)
+                    yield ObservationColumns(history)
+                    start = time.time()
+            except sqlite3.Error as e:
+                raise WeatherDBError(e.args[0])
+            finally:
+                cur.close()
+                metrics.SQL(name, elapsed, read=read)
+
+    def DownsampleObservations(self, _since=None, _until=None, _points=500, _mode="lttb", _fields=None):
+        """
+            Reduces every observation recorded after _since and up to and
+            including _until to about _points points per observation type
+            with the downsample module, in one pass over the cursor.
+            Returns a dict of type to [[time, value], ...], for the types in
+            _fields only when it is given.
+        """
+        # Raises ValueError for unknown fields
+        self._Projection(_fields)
+        since, until = self._Range(_since, _until)
+        names = tuple(name for name in self.ROLLUP_TYPES if _fields is None or name in _fields)
+        if not names:
+            return dict()
+
+        # Buckets are spread over the data actually stored in the range
+        bounds = [self._ReadDB("SELECT_RANGE_BOUNDS", self.SELECT_RANGE_BOUNDS.format(table),
+                               (since, until))[0]
+                  for table in self._Sources(since, until, True)]
+        bounds = [bound for bound in bounds if bound[0] is not None]
+        if not bounds:
+            return dict((name, []) for name in names)
+
+        start = min(bound[0] for bound in bounds)
+        end = max(bound[1] for bound in bounds)
+        columns = ", ".join(["timestamp"] + [dict(self.FIELD_COLUMNS)[name] for name in names])
+        sqls = (self.SELECT_SERIES.format(table, columns) for table in self._Sources(since, until, True))
+        rows = self._FetchRows("SELECT_SERIES", sqls, (since, until))
+        return downsample.Downsample(rows, start, end, _points, _mode, names)
+
+    def _FetchRows(self, name, sqls, params, _batch=500):
+        # Yields the rows of each of sqls in turn, fetchmany at a time from
+        # a cursor of its own
+        for sql in sqls:
+            cur = self.conn.cursor()
+            elapsed = 0.0
+            read = 0
+            try:
+                start = time.time()
+                cur.execute(sql, params)
+                while True:
+                    rows = cur.fetchmany(_batch)
+                    elapsed += time.time() - start
+                    if not rows:
+                        break
+
+                    read += len(rows)
+                    for row in rows:
+                        yield row
+                    start = time.time()
+            except sqlite3.Error as e:
+                raise WeatherDBError(e.args[0])
+            finally:
+                cur.close()
+                metrics.SQL(name, elapsed, read=read)
+
     def AddObservation(self, _obs):
-        wObs = WeatherObservation(_obs).getObservation()
+        # Observations are validated and clamped once, here, reads trust the
+        # stored values
+        columns, errors, fields = ValidateBatch([_obs])
+        if errors:
+            raise InvalidObservationError(errors[0]["error"])
+
+        # Stored the same way as a group of the ingest queue
+        result = self.AddObservationRows(columns.rows())[0]
+        if result == "duplicate":
+            raise DuplicateObservationError("An observation is already stored for this timestamp")
+        if result == "archived":
+            raise ArchivedObservationError("The month of this observation has been archived")
+
+    def AddObservations(self, _observations):
+        """
+            Validates and stores a batch of observations in one transaction.
+            Invalid observations are skipped and observations whose timestamp
+            is already stored are ignored, returns a dict of counts, the
+            index and reason of each invalid observation and the number of
+            clamped and rejected values per field. Observations in archived
+            months are counted but not stored.
+        """
+        columns, errors, fields = ValidateBatch(_observations)
+
+        # Only the rows actually inserted reach the rollups and the live feed
+        results = self.AddObservationRows(columns.rows()) if len(columns) else []
+
+        return {
+            "accepted": results.count("stored"),
+            "duplicates": results.count("duplicate"),
+            "rejected": len(errors),
+            "archived": results.count("archived"),
+            "errors": errors,
+            "fields": fields
+        }
+
+    def AddObservationRows(self, _rows):
+        """
+            Stores rows already validated by ValidateBatch in one
+            transaction, the group commit of the ingest queue. Returns
+            "stored", "duplicate" or "archived" for each row.
+        """
+        archivedUntil = self._ArchivedUntil()
+        results = list()
+        stored = list()
+        start = time.time()
+        try:
+            for row in _rows:
+                if row[5] <= archivedUntil:
+                    results.append("archived")
+                    continue
+
+                # Executed one at a time to tell duplicates apart, the
+                # single commit is what makes a group cheap
+                self.cur.execute(self.INSERT_OBSERVATION_BATCH, row)
+                if self.cur.rowcount == 1:
+                    results.append("stored")
+                    stored.append(row)
+                else:
+                    results.append("duplicate")
+
+            # The stored rows are folded into their rollup buckets rather
+            # than the buckets being recomputed
+            if stored:
+                for sql, params in self._RollupUpdates(stored):
+                    self.cur.executemany(sql, params)
+                self.cur.execute(self.BUMP_WRITES)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            raise WeatherDBError(e.args[0])
+
+        metrics.SQL("INSERT_OBSERVATION_BATCH", time.time() - start, written=len(stored))
+        if stored:
+            observations = [ObservationRecord.fromRow(row).toDict() for row in stored]
+
+            # Write through to the latest observation cache, our own commits
+            # do not change data_version so the cached entry stays valid
+            newest = max(observations, key=lambda obs: obs["time"])
+            cached = self.state.get("latest")
+            if cached and cached[1]["time"] <= newest["time"]:
+                self.state["latest"] = (cached[0], newest)
+
+            live.FEED.Publish(observations)
+
+        return results
+
+    def LatestObservation(self, _fields=None):
+        # Returns None while the database is still empty. The result is
+        # cached per connection until PRAGMA data_version reports a commit
+        # from another connection, which covers other threads and workers.
+        # With _fields a miss reads only their columns and is not cached.
+        version = self._ReadDB("DATA_VERSION", self.DATA_VERSION)[0][0]
+        cached = self.state.get("latest")
+        metrics.Cache("latest", bool(cached and cached[0] == version))
+        if cached and cached[0] == version:
+            return Project(cached[1], _fields)
+
+        columns = self._Projection(_fields)
+        for table in self._Sources(self.MIN_TIMESTAMP, self.MAX_TIMESTAMP):
+            rows = self._ReadDB("SELECT_LATEST", self.SELECT_LATEST.format(table, columns))
+            if rows:
+                break
+        else:
+            return None
+
+        if _fields is not None:
+            return ObservationRecord.fromRow(rows[0]).toDict(_fields)
+
+        latest = ObservationRecord.fromRow(rows[0]).toDict()
+        self.state["latest"] = (version, latest)
+        return latest
+
+    def _RollupUpdates(self, rows):
+        # Statements folding new observation rows into every rollup. Missing
+        # buckets are all created first, seeded with one of their rows, so
+        # the updates of every row can then run as one batch.
+        then = list()
+        for resolution, width in self.ROLLUP_RESOLUTIONS.items():
+            inserts = list()
+            updates = list()
+            for row in rows:
+                bucket = row[5] - row[5] % width
+                insert = [bucket]
+                update = list()
+                for value in row[:5]:
+                    insert += [value, value]
+                    update += [value, value, value]
+                inserts.append(insert)
+                updates.append(update + [bucket])
+
+            then.append((self.INSERT_ROLLUP.format(resolution), inserts))
+            then.append((self.UPDATE_ROLLUP.format(resolution), updates))
+
+        return then
+
+    def ArchiveMonth(self, _year, _month):
+        """
+            Moves every observation of a UTC month out of the observations
+            table into its own database file next to the main one, which
+            is then made read-only. Months have to be archived oldest
+            first so the observations table only ever holds the newest
+            data. Returns the number of observations archived.
+        """
+        month = _year * 100 + _month
+        first = calendar.timegm((_year, _month, 1, 0, 0, 0))
+        last = calendar.timegm((_year + _month // 12, _month % 12 + 1, 1, 0, 0, 0)) - 1
+
+        if self._ReadDB("SELECT_PARTITION", self.SELECT_PARTITION, (month,)):
+            raise WeatherDBError("{} is already archived".format(month))
+        oldest = self._ReadDB("SELECT_OLDEST", self.SELECT_OLDEST)[0][0]
+        if oldest is not None and oldest < first:
+            raise WeatherDBError("Older months must be archived before {}".format(month))
+
+        name = self.ARCHIVE_FILE.format(_year, _month)
+        path = self._ArchivePath(name)
+        if os.path.exists(path):
+            # Left over from an archive run that did not finish
+            os.chmod(path, 0o644)
+
+        # Copy the month into its archive first, only once that has been
+        # committed are the rows removed and the month recorded, together,
+        # so every row is always readable from exactly one place
+        schema = "archive_new"
+        self._ReadDB("ATTACH_ARCHIVE", self.ATTACH_ARCHIVE.format(schema), (path,))
+        try:
+            self._WriteDB("CREATE_TABLE_ARCHIVE", self.CREATE_TABLE_ARCHIVE.format(schema),
+                    then=[(self.COPY_TO_ARCHIVE.format(schema), [(first, last)])])
+            count = self._ReadDB("COUNT_ARCHIVE", self.COUNT_ARCHIVE.format(schema))[0][0]
+        finally:
+            self._ReadDB("DETACH_ARCHIVE", self.DETACH_ARCHIVE.format(schema))
+
+        self._WriteDB("DELETE_ARCHIVED", self.DELETE_ARCHIVED, (first, last),
+                [(self.INSERT_PARTITION, [(month, name, first, last, count)])])
+        os.chmod(path, 0o444)
+
+        return count
+
+    def ArchiveBefore(self, _year, _month):
+        # Archives every month older than the given one, oldest first.
+        # Returns the list of (year, month, observations) archived.
+        cutoff = calendar.timegm((_year, _month, 1, 0, 0, 0))
+        archived = list()
+        while True:
+            oldest = self._ReadDB("SELECT_OLDEST", self.SELECT_OLDEST)[0][0]
+            if oldest is None or oldest >= cutoff:
+                return archived
+
+            year, month = time.gmtime(oldest)[:2]
+            archived.append((year, month, self.ArchiveMonth(year, month)))
+
+    def _ArchivedUntil(self):
+        # Last timestamp of the newest archived month
+        until = self._ReadDB("SELECT_ARCHIVED_UNTIL", self.SELECT_ARCHIVED_UNTIL)[0][0]
+        return self.MIN_TIMESTAMP if until is None else until
+
+    def _ArchivePath(self, name):
+        return os.path.join(os.path.dirname(os.path.abspath(self.dbfile)), name)
+
+    def _Sources(self, since, until, _ascending=False):
+        """
+            Yields the observation tables that can hold rows in the range,
+            newest first unless _ascending: the observations table and the
+            archived months that overlap the range. Archives are attached
+            when they are reached, so a range that stays within the recent
+            months never opens an archive file.
+        """
+        months = self._ReadDB("SELECT_PARTITIONS", self.SELECT_PARTITIONS, (since, until))
+        if not months:
+            yield "observations"
+            return
+
+        if _ascending:
+            for month, name in reversed(months):
+                yield self._Attach(month, name)
+            yield "observations"
+        else:
+            yield "observations"
+            for month, name in months:
+                yield self._Attach(month, name)
+
+    def _Attach(self, month, name):
+        # Attaches an archive to this connection, detaching the least
+        # recently used one when ARCHIVE_ATTACH_LIMIT are already attached
+        schema = "p{}".format(month)
+        attached = self.state.setdefault("attached", list())
+        if schema in attached:
+            attached.remove(schema)
+        else:
+            if len(attached) >= self.ARCHIVE_ATTACH_LIMIT:
+                self._ReadDB("DETACH_ARCHIVE", self.DETACH_ARCHIVE.format(attached.pop(0)))
+            self._ReadDB("ATTACH_ARCHIVE", self.ATTACH_ARCHIVE.format(schema),
+                         (self._ArchivePath(name),))
+
+        attached.append(schema)
+        return schema + ".observations"
+
+    def Validator(self):
+        """
+            Returns (newest timestamp, write count, time of the last write)
+            for the HTTP validators, None while no observation is stored.
+        """
+        newest = self.NewestTimestamp()
+        if newest is None:
+            return None
+
+        count, modified = self._ReadDB("SELECT_WRITES", self.SELECT_WRITES)[0]
+        return newest, count, modified
+
+    def NewestTimestamp(self):
+        # Timestamp of the newest stored observation, None if there are none.
+        # Served from the latest observation cache when it is current,
+        # otherwise only the primary key is read and nothing is cached, so
+        # a projected LatestObservation after it still reads its columns.
+        version = self._ReadDB("DATA_VERSION", self.DATA_VERSION)[0][0]
+        cached = self.state.get("latest")
+        if cached and cached[0] == version:
+            return cached[1]["time"]
+
+        for table in self._Sources(self.MIN_TIMESTAMP, self.MAX_TIMESTAMP):
+            newest = self._ReadDB("SELECT_NEWEST", self.SELECT_NEWEST.format(table))[0][0]
+            if newest is not None:
+                return newest
+
+        return None
+
 
-        # Add observation values to the sql statement
-        rtn = self._WriteDB(self.INSERT_OBSERVATION.format(wObs["temp"], wObs["pres"], wObs["rhum"], 
-                wObs["lux"]["luxd"], wObs["alt"], wObs["time"]))
+if __name__ == "__main__":
+    import sys
 
-        print rtn
-        if not rtn:
-            raise Exception(rtn)
+    if len(sys.argv) in (2, 3) and sys.argv[1] == "rollup":
+        # One-off rebuild of the rollup tables, for databases changed
+        # outside WeatherHistory
+        wh = WeatherHistory(sys.argv[2] if len(sys.argv) == 3 else None)
+        wh.RebuildRollups()
+        print("Rollups rebuilt")
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "archive":
+        # Archive every month before the newest <keep> months, then reclaim
+        # the space they used in the main database file
+        keep = int(sys.argv[2])
+        year, month = time.gmtime()[:2]
+        month -= keep - 1
+        while month < 1:
+            year, month = year - 1, month + 12
 
-    def LatestObservation(self):
-        return WeatherObservation(self._ReadDB(self.SELECT_LATEST)[0]).getObservation()
+        wh = WeatherHistory(sys.argv[3] if len(sys.argv) == 4 else None)
+        archived = wh.ArchiveBefore(year, month)
+        for year, month, count in archived:
+            print("Archived {:04d}-{:02d}: {} observations".format(year, month, count))
+        if archived:
+            wh.conn.execute("VACUUM;")
+    else:
+        print("usage: %s rollup [dbfile]" % sys.argv[0])
+        print("       %s archive <months to keep> [dbfile]" % sys.argv[0])
+        sys.exit(2)